@@ -0,0 +1,26 @@
+["task"]
+CLIENTDELIM
+import time
+
+# Every benchmark task is a string "<profile> <work> <padding>" and is
+# answered with itself, so the padding travels both ways. With the legacy
+# codec the tasks of a job arrive joined by underscores and go back the same
+# way.
+def task(self, tasks):
+    if not isinstance(tasks, list):
+        return "_".join(run_task(description) for description in tasks.split("_"))
+    return [run_task(description) for description in tasks]
+
+
+# "noop" does nothing, "sleep" sleeps work seconds and "cpu" spins for work
+# iterations.
+def run_task(description):
+    profile, work, padding = description.split(" ", 2)
+    if profile == "sleep":
+        time.sleep(float(work))
+    elif profile == "cpu":
+        total, i = 0, 0
+        while i < int(work):
+            total += i * i
+            i += 1
+    return description
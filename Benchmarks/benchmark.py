@@ -0,0 +1,283 @@
+from distribuPy import *
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+# Loopback benchmarks of the coordinator and the wire protocol. Every run
+# starts a DistributedTaskManager and a number of DistributedTaskClient
+# processes on localhost, hands out a fixed number of synthetic tasks and
+# measures tasks and megabytes per second, job latency percentiles and the
+# CPU time the coordinator process used. Each option takes a comma
+# separated list and every combination is run. Results are written as JSON
+# so the results of two versions can be compared with --compare.
+
+CLIENT_CODE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ClientCode.py")
+
+# Options swept over, in the order results are listed.
+SWEEP = ("profile", "payload_size", "tasks_per_job", "workers", "integrators", "engine", "wire")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark distribuPy over loopback.")
+    parser.add_argument("--profiles", default="noop,sleep,cpu",
+                        help="Task profiles: noop, sleep or cpu.")
+    parser.add_argument("--payload-sizes", default="0,1024,65536",
+                        help="Bytes of padding in every task and response.")
+    parser.add_argument("--tasks-per-job", default="1,20,100")
+    parser.add_argument("--workers", default="1,4", help="Numbers of client processes.")
+    parser.add_argument("--integrators", default="1,8", help="Numbers of jobIntegration threads.")
+    parser.add_argument("--engines", default="threads", help="Coordinator engines: threads or eventloop.")
+    parser.add_argument("--wire", default="framed", help="Client wire protocols: framed or legacy.")
+    parser.add_argument("--codec", default="pickle", help="Payload codec offered to framed clients.")
+    parser.add_argument("--tasks", type=int, default=2000, help="Tasks per run.")
+    parser.add_argument("--sleep", type=float, default=0.001, help="Seconds every sleep task sleeps.")
+    parser.add_argument("--cpu", type=int, default=20000, help="Iterations every cpu task spins for.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds before a run is given up.")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two result files instead of running.")
+    parser.add_argument("--client", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client is not None:
+        run_client(args.client, args.wire)
+    elif args.compare:
+        compare(*args.compare)
+    else:
+        run_sweep(args)
+
+
+# Client Side #
+
+def run_client(port, wire_protocol):
+    client = DistributedTaskClient(wire_protocol)
+    client.setup("127.0.0.1", port)
+    client.run()
+
+
+def start_client(port, wire_protocol):
+    with open(os.devnull, "w") as devnull:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--client", str(port),
+                                 "--wire", wire_protocol], stdout=devnull)
+
+
+# Coordinator Side #
+
+class BenchmarkManager(DistributedTaskManager):
+    client_code_path = CLIENT_CODE_PATH
+
+    def __init__(self, config, task_count, work):
+        self.config = config
+        self.task_count = task_count
+        self.description_prefix = "{} {} ".format(config["profile"], work)
+        self.padding = "x" * config["payload_size"]
+        self.answered = 0
+        self.recorded = 0
+        # Seconds from sending each job to receiving its result.
+        self.latencies = []
+        self.started_at = None
+        self.finished_at = None
+        self.cpu_started = None
+        self.cpu_finished = None
+        self.lock = threading.Lock()
+
+        DistributedTaskManager.__init__(self, config["tasks_per_job"])
+        self.verbose = False
+        self.engine = config["engine"]
+        self.num_job_integrators = config["integrators"]
+        self.codecs = [config["codec"], "legacy"]
+
+    # Holds the tasks back until every client has connected so they all
+    # start together.
+    def choose_job(self, session):
+        if len(self.sessions) < self.config["workers"]:
+            return None
+        with self.lock:
+            if self.started_at is None:
+                self.started_at = time.time()
+                self.cpu_started = cpu_time()
+        return DistributedTaskManager.choose_job(self, session)
+
+    def open_session(self, connection, peer_name):
+        session = DistributedTaskManager.open_session(self, connection, peer_name)
+        self.notify_tasks_available()
+        return session
+
+    def handle_message(self, session, msg_type, job_id, responses, meta):
+        answered = time.time()
+        sent_at = session.sent_at.get(job_id)
+        DistributedTaskManager.handle_message(self, session, msg_type, job_id, responses, meta)
+        if sent_at is not None and msg_type == MSG_RESULT:
+            with self.lock:
+                self.latencies.append(answered - sent_at)
+
+    # Returns the measurements of a finished run.
+    def results(self):
+        wall = self.finished_at - self.started_at
+        cpu = self.cpu_finished - self.cpu_started
+        workers = self.metrics_snapshot()["workers"].values()
+        transferred = sum(worker["bytes_sent"] + worker["bytes_received"] for worker in workers)
+        latencies = sorted(self.latencies)
+        return {"wall_seconds": wall, "tasks": self.recorded, "jobs": len(latencies),
+                "tasks_per_second": self.recorded / wall,
+                "megabytes_per_second": transferred / wall / 1e6,
+                "latency_p50": percentile(latencies, 50), "latency_p99": percentile(latencies, 99),
+                "coordinator_cpu_seconds": cpu, "coordinator_cpu_percent": 100.0 * cpu / wall}
+
+    def is_repetition_finished(self, ):
+        return self.answered == self.task_count
+
+    def is_simulation_finished(self, ):
+        return self.repetitions_finished >= 1
+
+    def task_generator(self):
+        for task_id in range(self.task_count):
+            yield (task_id, self.description_prefix + self.padding)
+
+    def reset_responses(self):
+        pass
+
+    def set_next_repetition(self):
+        pass
+
+    def record_response(self, task, response):
+        with self.lock:
+            self.answered += 1
+        self.job_buffer.append(response)
+
+    def record_job(self, job):
+        with self.lock:
+            self.recorded += 1
+            if self.recorded == self.task_count:
+                self.finished_at = time.time()
+                self.cpu_finished = cpu_time()
+
+
+# User and system CPU seconds used by this process so far.
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+# Nearest-rank percentile of sorted values.
+def percentile(values, percent):
+    if not values:
+        return None
+    index = max(0, int(len(values) * percent / 100.0 + 0.5) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+# Runs one combination of options and returns its config and results.
+def run_benchmark(config, task_count, work, timeout):
+    manager = BenchmarkManager(config, task_count, work)
+    manager.setup("127.0.0.1", 0)
+    port = manager.servers[0].getsockname()[1]
+    manager.start_all()
+    clients = [start_client(port, config["wire"]) for i in range(config["workers"])]
+
+    deadline = time.time() + timeout
+    while not manager.stop and time.time() < deadline:
+        time.sleep(0.05)
+    manager.request_stop()
+    if manager.sim_thread.is_alive():
+        manager.sim_thread.join(timeout)
+    stop_clients(clients)
+
+    result = dict(config)
+    if manager.finished_at is None:
+        result["error"] = "Timed out after {} seconds".format(timeout)
+    else:
+        result.update(manager.results())
+    return result
+
+
+# Waits for the clients to disconnect, killing any that don't.
+def stop_clients(clients, grace=5.0):
+    deadline = time.time() + grace
+    for client in clients:
+        while client.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if client.poll() is None:
+            client.kill()
+            client.wait()
+
+
+def split(value, kind=str):
+    return [kind(item) for item in value.split(",") if item]
+
+
+def run_sweep(args):
+    options = {"profile": split(args.profiles), "payload_size": split(args.payload_sizes, int),
+               "tasks_per_job": split(args.tasks_per_job, int), "workers": split(args.workers, int),
+               "integrators": split(args.integrators, int), "engine": split(args.engines),
+               "wire": split(args.wire)}
+    work = {"noop": 0, "sleep": args.sleep, "cpu": args.cpu}
+    results = []
+    for values in itertools.product(*[options[name] for name in SWEEP]):
+        config = dict(zip(SWEEP, values))
+        config["codec"] = args.codec
+        result = run_benchmark(config, args.tasks, work[config["profile"]], args.timeout)
+        results.append(result)
+        print(describe(result))
+
+    report = {"created": time.time(), "python": sys.version.split()[0], "platform": platform.platform(),
+              "commit": git_commit(), "tasks": args.tasks, "sleep": args.sleep, "cpu": args.cpu,
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+
+def describe(result):
+    config = " ".join("{}={}".format(name, result[name]) for name in SWEEP)
+    if "error" in result:
+        return "{}: {}".format(config, result["error"])
+    return "{}: {:.0f} tasks/s {:.2f} MB/s p50 {:.2f} ms p99 {:.2f} ms cpu {:.0f}%".format(
+        config, result["tasks_per_second"], result["megabytes_per_second"],
+        1000 * result["latency_p50"], 1000 * result["latency_p99"], result["coordinator_cpu_percent"])
+
+
+# The commit of the checkout being benchmarked, if it is a git checkout.
+def git_commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull,
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Prints the change in throughput, latency and coordinator CPU between the
+# runs with matching options in two result files.
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    key = lambda result: tuple(result.get(name) for name in SWEEP + ("codec",))
+    earlier = dict((key(result), result) for result in before["results"] if "error" not in result)
+    for result in after["results"]:
+        old = earlier.get(key(result))
+        if old is None or "error" in result:
+            continue
+        config = " ".join("{}={}".format(name, result[name]) for name in SWEEP)
+        print("{}: tasks/s {} p50 {} p99 {} cpu {}".format(
+            config, change(old, result, "tasks_per_second"), change(old, result, "latency_p50"),
+            change(old, result, "latency_p99"), change(old, result, "coordinator_cpu_seconds")))
+
+
+def change(old, new, name):
+    if not old[name]:
+        return "n/a"
+    return "{:+.1f}%".format(100.0 * (new[name] - old[name]) / old[name])
+
+
+if __name__ == '__main__':
+    main()
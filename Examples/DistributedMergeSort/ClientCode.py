@@ -1,11 +1,19 @@
-["task"]
+["task", "combine"]
 CLIENTDELIM
 
 def task(self, tasks):
-    tasks = tasks.split("_")    
-    reply = ""
-    for task in tasks:
-        data = eval(task)
-        data.sort()
-        reply +=  str(data) + "_"
-    return reply[:-1]
\ No newline at end of file
+    return [sorted(data) for data in tasks]
+
+# Merges two sorted lists, letting clients merge sorted divisions before the
+# server sees them.
+def combine(self, first, second):
+    merged = []
+    index1, index2 = 0, 0
+    while index1 < len(first) and index2 < len(second):
+        if first[index1] < second[index2]:
+            merged.append(first[index1])
+            index1 += 1
+        else:
+            merged.append(second[index2])
+            index2 += 1
+    return merged + first[index1:] + second[index2:]
@@ -33,6 +33,12 @@ class MergeSortServer(DistributedTaskManager):
         print("numDivs: {}".format(self.numDivs))
 
         DistributedTaskManager.__init__(self, tasks_per_job)
+        # Divisions are lists of floats so they travel as packed doubles.
+        self.codecs = ["array", "pickle"]
+        # Clients merge the divisions they sort, and merge each other's
+        # results four at a time, so only a few long lists reach mergeOperation.
+        self.client_combining = True
+        self.reduction_fan_in = 4
 
     def writeData(self):
         f = open("out","w+")
@@ -96,19 +102,20 @@ class MergeSortServer(DistributedTaskManager):
     # this entails putting something into the jobBuffer for the recordJob
     # function to use at a later time.
     def record_response(self, task, response):
-        with self.responseLock:
-            self.job_buffer.append((task, response))
+        self.job_buffer.append(([task], response))
+
+    # Records a sorted list merged by the clients from several divisions.
+    def record_combined_response(self, tasks, response):
+        self.job_buffer.append((tasks, response))
 
     # User overwrites this function to define what it means to record a job,
     # these jobs are being pulled out of the jobBuffer which is populated by
     # the recordResponse function that the user overwrites.
     def record_job(self, job):
-        task, response = job
-        taskID, taskData = task
+        tasks, response = job
         with self.responseLock:
-            response = eval(response)
             self.mergeOperation(response)
-            self.numReplies += 1
+            self.numReplies += len(tasks)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,15 @@
-["task","Window", "mandelBrot", "transform"]
+["task", "renderTile", "Window", "mandelBrot", "transform"]
 CLIENTDELIM
 
 def task(self, tasks):
-    tasks = tasks.split("_")
-    task = eval(tasks[0])
+    return [self.renderTile(self, task) for task in tasks]
 
+def renderTile(self, task):
     # Extract info from task
     px = task[0]
     py = task[1]
-    maxItters = task[2]
-    tiling = task[3]
-    self.rx,self.ry = task[4]
-    windowInfo = task[5]
+    maxItters, tiling, resolution, windowInfo = self.get_object(task[2])
+    self.rx,self.ry = resolution
     window = self.Window(windowInfo[:2], windowInfo[2:])
 
     #list to contain pixel values
@@ -27,7 +25,7 @@ def task(self, tasks):
             pixels.append((xi,yi,color))
 
     #Send back the pixels array
-    return str(pixels)
+    return pixels
 
 #Blatently copied from wikipedia page on mandelbrot set
 def mandelBrot(self, pixel, window, maxItters = 100):
@@ -69,6 +69,7 @@ class MandelrotServer(DistributedTaskManager):
         self.nestingFactor = 10.0/5.0
 
         DistributedTaskManager.__init__(self, tasks_per_job)
+        self.codecs = ["msgpack", "pickle"]
 
     #Save the current image.
     def saveImage(self, fName):
@@ -148,14 +149,16 @@ class MandelrotServer(DistributedTaskManager):
     # Definition of how to send divide tasks
     def task_generator(self):
         taskID = 0
+        #The number of itterations to quit at, the tiling structure, resolution,
+        # and window information are the same for every tile of a frame, so
+        # they are shared by handle instead of being sent with every task.
+        self.frame = self.put((self.maxItters, self.tiling, (self.rx,self.ry), self.window.toList()))
         for x in range(self.tiling[0]):
             print("Giving column tile {}".format(x))
             for y in range(self.tiling[1]):
                 taskID += 1
-                #Send over the tile row, column, number of itterations to quit at,
-                # the tiling structure, resolution, and window information.
-                yield(taskID,(x,y, self.maxItters,self.tiling,
-                      (self.rx,self.ry), self.window.toList()))
+                #Send over the tile row, column and the frame information.
+                yield(taskID,(x,y, self.frame))
 
     #Reset the response counter for the next itteration
     def reset_responses(self):
@@ -164,6 +167,7 @@ class MandelrotServer(DistributedTaskManager):
     #Zoom in and save current image
     def set_next_repetition(self):
         if self.repetitions_finished != 0:
+            self.release(self.frame)
             self.w /= self.nestingFactor
             self.h /= self.nestingFactor
             self.window = Window((self.x, self.y),(self.w, self.h))
@@ -172,16 +176,15 @@ class MandelrotServer(DistributedTaskManager):
 
     #Put response into the job Buffer, increment number of replies received.
     def record_response(self, task, response):
+        self.job_buffer.append((task, response))
         with self.responseLock:
             self.numReplies += 1
-            self.job_buffer.append((task, response))
 
     #Process a job by painting pixels
     def record_job(self, job):
         task, response = job
         taskID, taskData = task
         with self.responseLock:
-            response = eval(response)
             self.paintPixels(response)
 
 #This class defines a region in the plane that makes up an image.
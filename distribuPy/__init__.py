@@ -1 +1,3 @@
 from distribuPy import *
+from .executor import DistributedExecutor
+from .workloads import WorkloadManager
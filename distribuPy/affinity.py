@@ -0,0 +1,85 @@
+import threading
+import time
+
+
+# Affinity Scheduling #
+
+# Tasks can name affinity keys, such as the data partition, tile region or
+# shared object they need. A client that was given a task with some key is
+# assumed to hold whatever goes with it afterwards. Instead of handing tasks
+# out in generator order, a lookahead buffer of upcoming tasks is kept and
+# each client is given the tasks with keys it holds first. A task whose keys
+# another client holds waits for that client for up to the affinity delay,
+# after which any client may take it.
+
+class AffinityBuffer:
+    def __init__(self):
+        # [repetition, task, keys, buffered_at] entries in generator order.
+        self.entries = []
+        # Sessions holding each key.
+        self.holders = {}
+        self.lock = threading.Lock()
+
+    # Takes up to count tasks of a single repetition for session, tasks that
+    # match its keys first. source() returns the next (repetition, task) to
+    # buffer or None, keys(task) the affinity keys of a task. Returns the
+    # repetition and the tasks.
+    def take(self, session, count, lookahead, delay, source, keys):
+        with self.lock:
+            # A job is never capped at the lookahead.
+            while len(self.entries) < max(lookahead, count):
+                item = source()
+                if item is None:
+                    break
+                repetition, task = item
+                self.entries.append([repetition, task, set(keys(task) or ()), time.time()])
+
+            now = time.time()
+            preferred, others = [], []
+            for entry in self.entries:
+                if entry[2] & session.affinity_keys:
+                    preferred.append(entry)
+                elif self.available(entry, session, now, delay):
+                    others.append(entry)
+            chosen = []
+            for entry in preferred + others:
+                if len(chosen) == count:
+                    break
+                if not chosen or entry[0] == chosen[0][0]:
+                    chosen.append(entry)
+            if not chosen:
+                return None, []
+
+            taken = set(id(entry) for entry in chosen)
+            self.entries = [entry for entry in self.entries if id(entry) not in taken]
+            for entry in chosen:
+                for key in entry[2] - session.affinity_keys:
+                    self.holders.setdefault(key, set()).add(session)
+                session.affinity_keys |= entry[2]
+            return chosen[0][0], [entry[1] for entry in chosen]
+
+    # Whether session may take a task that doesn't match its keys: it has no
+    # keys, nobody else holds them, or it has waited long enough.
+    def available(self, entry, session, now, delay):
+        if now - entry[3] >= delay:
+            return True
+        for key in entry[2]:
+            if self.holders.get(key, set()) - set([session]):
+                return False
+        return True
+
+    # Whether a task is waiting for its holders past the delay, so idle
+    # clients should be woken to take it.
+    def overdue(self, now, delay):
+        with self.lock:
+            return any(entry[2] and now - entry[3] >= delay for entry in self.entries)
+
+    # Drops the keys of a session that went away.
+    def forget(self, session):
+        with self.lock:
+            for key in session.affinity_keys:
+                sessions = self.holders.get(key)
+                if sessions is not None:
+                    sessions.discard(session)
+                    if not sessions:
+                        del self.holders[key]
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Checkpoints #
+
+# Lets a manager that died pick up where it left off. Every recorded response
+# is appended to a log together with its task and repetition, and between
+# repetitions the user state and the number of finished repetitions are saved
+# to a snapshot, after which the log starts over. Writing happens in batches
+# on a thread of its own so recording a response only has to queue it.
+
+class Checkpoint:
+    # Files are named path + ".log" and path + ".snapshot". The log is
+    # flushed to disk at most every flush_interval seconds. Snapshots are
+    # taken at most every snapshot_interval seconds.
+    def __init__(self, path, flush_interval=1.0, snapshot_interval=60.0):
+        self.log_path = path + ".log"
+        self.snapshot_path = path + ".snapshot"
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.last_snapshot = time.time()
+
+        self.queue = []
+        self.closing = False
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.log = None
+        self.thread = None
+
+    # Returns the last snapshot, or None if there is none, and the entries
+    # logged since, leaving out any cut short by a crash.
+    def load(self):
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        entries = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                while True:
+                    try:
+                        entries.append(pickle.load(f))
+                    except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, ImportError, IndexError):
+                        break
+        return snapshot, entries
+
+    def start(self):
+        if self.thread is None:
+            self.log = open(self.log_path, "ab")
+            self.thread = threading.Thread(target=self.writer_thread)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Queues an entry for the log.
+    def append(self, entry):
+        with self.lock:
+            self.queue.append(entry)
+            self.ready.notify()
+
+    def snapshot_due(self):
+        return time.time() - self.last_snapshot >= self.snapshot_interval
+
+    # Queues a snapshot of the given data, which is pickled right away so it
+    # can't change before it is written. Entries queued before the snapshot
+    # are dropped along with the rest of the log once it has been written.
+    def snapshot(self, data):
+        self.last_snapshot = time.time()
+        self.append(SnapshotMarker(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+
+    # Writes everything still queued and stops the writer.
+    def close(self):
+        with self.lock:
+            self.closing = True
+            self.ready.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def writer_thread(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closing:
+                    self.ready.wait()
+                closing = self.closing
+            # Let entries pile up so they are written and synced together.
+            if not closing:
+                time.sleep(self.flush_interval)
+            with self.lock:
+                entries, self.queue = self.queue, []
+            for entry in entries:
+                if isinstance(entry, SnapshotMarker):
+                    self.write_snapshot(entry.data)
+                else:
+                    pickle.dump(entry, self.log, pickle.HIGHEST_PROTOCOL)
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            if closing:
+                self.log.close()
+                return
+
+    # Replaces the snapshot atomically, then truncates the log.
+    def write_snapshot(self, data):
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.snapshot_path)
+        self.log.close()
+        self.log = open(self.log_path, "wb")
+
+
+class SnapshotMarker:
+    def __init__(self, data):
+        self.data = data
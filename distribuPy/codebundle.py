@@ -0,0 +1,111 @@
+import hashlib
+import marshal
+import os
+import sys
+import types
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+
+# Client Code Bundles #
+
+# The client code sent to clients is a bundle of the ClientCode labels and
+# source plus any number of extra modules. A bundle is identified by a hash
+# of its content. Clients keep the bundles they have compiled in a cache
+# directory and tell the coordinator which hashes they hold, so a client
+# reconnecting with the same code needs neither the source nor a compile.
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".distribuPy", "code")
+
+# Number of cached bundles a client announces, most recent first.
+ANNOUNCED_BUNDLES = 16
+
+
+def as_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf-8")
+
+
+# Returns the hash of the labels and source of a bundle. modules is a list
+# of (name, source) pairs.
+def bundle_hash(labels, code, modules=()):
+    digest = hashlib.sha1()
+    for part in [labels, code] + [item for module in modules for item in module]:
+        part = as_bytes(part)
+        digest.update(as_bytes(str(len(part))) + b":" + part)
+    return digest.hexdigest()
+
+
+# Compiles a bundle, returning its labels, the code object of the client
+# code and a list of (name, code object) pairs for the modules.
+def compile_bundle(labels, code, modules=()):
+    compiled = [(name, compile(source, "<client module {}>".format(name), "exec")) for name, source in modules]
+    return labels, compile(code, "<client code>", "exec"), compiled
+
+
+# Makes the modules of a bundle importable, executing them in order.
+def install_modules(modules):
+    for name, code in modules:
+        module = types.ModuleType(str(name))
+        module.__file__ = "<client module {}>".format(name)
+        sys.modules[str(name)] = module
+        exec(code, module.__dict__)
+
+
+# Compiled bundles stored on disk by hash. Files are specific to the
+# interpreter's bytecode version.
+class CodeCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        self.suffix = "-{}.bundle".format(hashlib.sha1(MAGIC_NUMBER).hexdigest()[:8])
+
+    def path(self, code_hash):
+        return os.path.join(self.directory, code_hash + self.suffix)
+
+    # Hashes of the cached bundles, most recently used first.
+    def hashes(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(self.suffix)]
+        except OSError:
+            return []
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)), reverse=True)
+        return [name[:-len(self.suffix)] for name in names[:ANNOUNCED_BUNDLES]]
+
+    # Returns a cached compiled bundle, or None if it isn't cached or can't
+    # be read.
+    def load(self, code_hash):
+        path = self.path(code_hash)
+        try:
+            with open(path, "rb") as f:
+                stored = pickle.load(f)
+            os.utime(path, None)
+        except Exception:
+            return None
+        modules = [(name, marshal.loads(code)) for name, code in stored["modules"]]
+        return stored["labels"], marshal.loads(stored["code"]), modules
+
+    # Compiles a bundle, caches it under its hash and returns it compiled.
+    def store(self, code_hash, labels, code, modules=()):
+        bundle = compile_bundle(labels, code, modules)
+        stored = {"labels": labels, "code": marshal.dumps(bundle[1]),
+                  "modules": [(name, marshal.dumps(compiled)) for name, compiled in bundle[2]]}
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            temp_path = self.path(code_hash) + ".tmp{}".format(os.getpid())
+            with open(temp_path, "wb") as f:
+                pickle.dump(stored, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.path(code_hash))
+        except (IOError, OSError):
+            pass
+        return bundle
@@ -1,9 +1,38 @@
+import collections
+import functools
+import itertools
+import multiprocessing
 import threading
 import socket
 import time
 import sys
 import traceback
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from .protocol import (
+    MSG_HELLO, MSG_SETUP, MSG_JOB, MSG_RESULT, MSG_CLOSE, MSG_HEARTBEAT, MSG_OBJECT, MSG_CODE, FRAMED_MAGIC,
+    FramedConnection, LegacyConnection, encode_handshake, decode_handshake,
+    receive_exactly, send_large_message, receive_large_message,
+)
+from .serializers import LEGACY_CODEC, get_codec, available_codecs
+from .session import ClientSession, Job, smooth
+from .jobbuffer import JobBuffer
+from .eventloop import EventLoopEngine
+from .workerpool import WorkerPool
+from .repetition import Repetition
+from .integration import ShardedIntegrator
+from .resultcache import ResultCache
+from .codebundle import CodeCache, DEFAULT_CACHE_DIR, bundle_hash, compile_bundle, install_modules
+from .checkpoint import Checkpoint
+from .objectstore import ObjectStore, ObjectHandle, ObjectCache
+from .affinity import AffinityBuffer
+from .metrics import Metrics, MetricsServer, payload_size
+from .tracing import Tracer
+
 
 # Server Objects #
 
@@ -13,18 +42,83 @@ import traceback
 # Build GUI framework.
 
 class DistributedTaskManager:
-    def __init__(self, tasks_per_job=20):
-        self.job_buffer = []
+    # File the client code is read from.
+    client_code_path = "ClientCode.py"
+
+    def __init__(self, tasks_per_job=20, repetitions_in_flight=1):
+        # Jobs waiting to be recorded. While it holds max_size jobs no new
+        # jobs are dispatched.
+        self.job_buffer = JobBuffer(on_room=self.notify_tasks_available)
         self.drop_buffer = []
         self.servers = []
 
         self.client_labels = []
         self.client_code = ''
+        # Extra modules sent along with the client code as (name, source)
+        # pairs, see add_client_module. The hash of the whole bundle is
+        # worked out when it is first needed.
+        self.client_modules = []
+        self.client_code_hash = None
 
         self.stop = False
         self.verbose = True
 
         self.tasks_per_job = tasks_per_job
+        # Number of jobs that may be outstanding on one framed connection at
+        # once. Responses are matched to jobs by id so they may arrive in any
+        # order. Legacy connections are always limited to one.
+        self.jobs_in_flight = 2
+        # How connections are served. "threads" runs one thread per client
+        # with blocking I/O, "eventloop" serves every framed connection from a
+        # single thread (see start_all).
+        self.engine = "threads"
+        # Adaptive batching measures every client and sizes its jobs to take
+        # about target_job_duration seconds, keeping each job between
+        # min_tasks_per_job and max_tasks_per_job tasks. tasks_per_job is
+        # the starting size.
+        self.adaptive_batching = False
+        self.target_job_duration = 0.5
+        self.min_tasks_per_job = 1
+        self.max_tasks_per_job = 10000
+        # With speculative execution, once there are no tasks left to hand
+        # out, idle clients are given copies of the oldest outstanding jobs.
+        # The first result to arrive is recorded, the others are discarded.
+        # A job runs on at most max_job_copies clients at once.
+        self.speculative_execution = False
+        self.max_job_copies = 2
+        # With client combining, clients whose code defines a combine function
+        # merge the responses to the tasks of a job into one before sending
+        # it back, and record_combined_response is called instead of
+        # record_response. With a reduction_fan_in of two or more, combined
+        # responses are sent back out to combining clients that many at a
+        # time to be combined further, so the coordinator records only a few
+        # large results per repetition.
+        self.client_combining = False
+        self.reduction_fan_in = 0
+        # Combined responses waiting to be reduced, as (tasks, response)
+        # pairs by repetition. Guarded by jobs_lock.
+        self.partials = {}
+        # Every dispatched job that hasn't been answered, oldest first.
+        self.outstanding_jobs = collections.OrderedDict()
+        # Every connected client session. Guarded by jobs_lock.
+        self.sessions = set()
+        self.jobs_lock = threading.Lock()
+        # Framed clients send a heartbeat every heartbeat_interval seconds. A
+        # client with outstanding jobs that has been silent for
+        # heartbeat_timeout seconds is disconnected and its jobs requeued.
+        # Zero turns heartbeats off.
+        self.heartbeat_interval = 5.0
+        self.heartbeat_timeout = 20.0
+        # A job must be answered within deadline_factor times the time its
+        # client is expected to need for it, and never sooner than
+        # min_job_deadline seconds. Jobs that miss their deadline are
+        # requeued and their client gets no new jobs until it answers again.
+        # Zero turns deadlines off.
+        self.deadline_factor = 5.0
+        self.min_job_deadline = 10.0
+        # Smoothed compute seconds per task over every client, used for the
+        # deadlines of clients that haven't been timed yet.
+        self.task_time = None
         self.connection_backlog_max = 5
         self.connected = 0
         self.connected_lock = threading.Lock()
@@ -33,17 +127,70 @@ class DistributedTaskManager:
         self.bytesPerReceive = 1024
         # Number of bytes to use in smaller messages.
         self.small_message_size = 10
+        # Wire protocol offered to clients. "framed" uses binary headers with
+        # no per-message acknowledgement when the client supports it, while
+        # "legacy" always uses the size + "CONFIRMED" handshake.
+        self.wire_protocol = "framed"
+        # Payload codecs in order of preference. The first one the client also
+        # supports is used for its connection. Clients that can't negotiate
+        # only get in if "legacy" is listed.
+        self.codecs = ["legacy"]
+        self.job_ids = itertools.count(1)
         # How long between attempts to establish a server binding.
         self.retry_wait_time = 5
         # Number of seconds until server times out on connection.
         self.server_timeout = 2.0
-        # How many seconds the simulationManagerThread sleeps between pollings.
-        self.manager_sleep_time = 0.1
 
         # Name of a repetition. For example if this were set to 'Frame' the
         # debug log might contain something like: Frame 42 finished in 3.14159 seconds.
         self.repetition_name = "Repetition"
 
+        # How the jobs in the jobBuffer are recorded. "threads" calls
+        # record_job on the jobIntegration threads. "processes" forks
+        # integration_shards processes, one per core if None, which each
+        # record the jobs whose partition_key maps to them (see the
+        # user-defined functions below).
+        self.integration_backend = "threads"
+        self.integration_shards = None
+        self.integrator = None
+
+        # Shared objects that tasks refer to by handle, see put.
+        self.object_store = ObjectStore()
+
+        # Number of upcoming tasks to look through for ones whose affinity
+        # keys (see task_affinity) a client holds already. Zero hands tasks
+        # out in generator order. A task whose keys another client holds is
+        # kept for that client for up to affinity_delay seconds.
+        self.affinity_lookahead = 0
+        self.affinity_delay = 0.5
+        self.affinity = AffinityBuffer()
+
+        # Throughput, latency and queue metrics, see metrics_snapshot. With a
+        # metrics_port they are also served over HTTP in the Prometheus text
+        # format at /metrics on metrics_host.
+        self.metrics = Metrics()
+        self.metrics_host = "127.0.0.1"
+        self.metrics_port = None
+        self.metrics_server = None
+        # A Tracer that records where the time goes for every task, on the
+        # coordinator and on framed clients, to be written as a Chrome trace.
+        # None disables tracing.
+        self.tracer = None
+
+        # A ResultCache to answer tasks that have been answered before under
+        # the same client code without sending them out. None disables it.
+        self.result_cache = None
+        # A Checkpoint that every recorded response is logged to, so a
+        # manager restarted with the same checkpoint skips the tasks that
+        # were already answered. Requires the first element of every task to
+        # identify it within its repetition from one run to the next. None
+        # disables checkpointing.
+        self.checkpoint = None
+        # Logged entries still to be replayed and the ids of the tasks they
+        # answered, by repetition, when resuming from a checkpoint.
+        self.replay_entries = {}
+        self.completed_tasks = {}
+
         # The number of jobIntegration threads to be running.
         self.num_job_integrators = 8
         # The number of jobs that each jobIntegration thread will work with at
@@ -52,11 +199,46 @@ class DistributedTaskManager:
         self.jobs_to_pop = 10
 
         self.repetitions_finished = 0
+        # Number of repetitions whose tasks may be handed out at once. With
+        # more than one, the next repetition starts as soon as one finishes
+        # instead of waiting for the last stragglers and integration, and the
+        # user-defined functions below are called with the index of the
+        # repetition they concern as an extra argument.
+        self.repetitions_in_flight = repetitions_in_flight
+        # Repetitions started and not yet finished, by index, when
+        # repetitions overlap. Guarded by task_gen_lock.
+        self.active_repetitions = collections.OrderedDict()
 
         self.responseLock = threading.Lock()
-        self.reset_responses()
 
-        self.task_gen = self.task_generator()
+        # Signalled whenever something that may finish a repetition happens:
+        # responses recorded, jobs integrated or the manager stopping.
+        self.state_changed = threading.Condition()
+        # Signalled when new tasks may be available. task_epoch counts the
+        # signals so a waiting thread can tell whether it missed one.
+        self.tasks_available = threading.Condition()
+        self.task_epoch = 0
+        # Callables run whenever new tasks may be available.
+        self.task_listeners = []
+        # Messages from clients being handled, guarded by messages_done,
+        # and the jobIntegration threads, so shutdown can wait for both.
+        self.messages_in_progress = 0
+        self.messages_done = threading.Condition()
+        self.job_threads = []
+
+        # Overlapping repetitions reset their responses and make their task
+        # generators as they start.
+        self.task_gen = iter(())
+        # With adaptive batching, tasks taken from the task generator ahead
+        # of being handed out, at least read_ahead_size of them while it
+        # lasts, so the end of a repetition is seen coming. Guarded by
+        # task_gen_lock.
+        self.read_ahead = collections.deque()
+        self.read_ahead_size = 0
+        self.task_gen_exhausted = False
+        if self.repetitions_in_flight <= 1:
+            self.reset_responses()
+            self.task_gen = self.task_generator()
         self.task_gen_lock = threading.Lock()
 
         self.sim_thread = threading.Thread(target=self.simulation_management_thread)
@@ -85,13 +267,21 @@ class DistributedTaskManager:
             self.servers[-1].bind((ip, port))
         except:
             self.log("Could not establish server on {}".format(ip))
-            self.stop = True
+            self.request_stop()
             # TODO maybe instead return bad exit code.
             sys.exit(1)
         self.log("Server setup on {}".format(ip))
 
     # Starts all servers in the servers list.
     def start_all(self, ):
+        # Shard processes must be forked before any threads are running.
+        self.start_integrator()
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self, self.metrics_host, self.metrics_port)
+        if self.engine == "eventloop":
+            thread = threading.Thread(target=self.start_event_loop, args=(self.servers,))
+            thread.start()
+            return
         for server in self.servers:
             thread = threading.Thread(target=self.start, args=(server,))
             thread.start()
@@ -115,7 +305,7 @@ class DistributedTaskManager:
             except socket.timeout:
                 continue
             except:
-                self.stop = True
+                self.request_stop()
                 break
             self.log("CONNECTED TO: %s" % str(port))
 
@@ -123,9 +313,16 @@ class DistributedTaskManager:
             server.close()
         except:
             pass
-        self.stop = True
+        self.request_stop()
         self.log("EXITING MAIN")
 
+    # Serves every given server and all of their framed connections from a
+    # single event loop, also starts the simThread if it wasn't already alive.
+    def start_event_loop(self, servers):
+        if not self.sim_thread.isAlive():
+            self.sim_thread.start()
+        EventLoopEngine(self).run(servers)
+
     # Wait until the other threads have stopped. Returns true if everything ran
     # correctly, false otherwise.
     def spin(self, sleep_time=1.0):
@@ -134,40 +331,187 @@ class DistributedTaskManager:
                 time.sleep(sleep_time)
         except:
             self.log("Closing down...")
-            self.stop = True
+            self.request_stop()
             return False
         return True
 
     def simulation_management_thread(self, ):
+        self.job_buffer.timed = self.tracer is not None
+        self.start_integrator()
+        self.resume_from_checkpoint()
         self.create_job_integration_threads()
+        threading.Thread(target=self.health_monitor_thread).start()
 
         time.sleep(0.1)
+        if self.repetitions_in_flight > 1:
+            self.run_overlapping_repetitions()
+        else:
+            self.run_repetitions()
+
+        self.request_stop()
+        self.wait_for_handlers()
+        if self.integrator is not None:
+            self.integrator.close()
+        if self.result_cache is not None:
+            self.result_cache.close()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        if self.tracer is not None:
+            self.tracer.close()
+        self.close_servers()
+        self.log("Ending simulationManagementThread")
+
+    def start_integrator(self):
+        if self.integration_backend == "processes" and self.integrator is None:
+            self.integrator = ShardedIntegrator(self, self.integration_shards)
+
+    # Gathers what the shard processes recorded and hands it to
+    # combine_shards. Does nothing with the threads backend.
+    def combine_integration(self, *repetition):
+        if self.integrator is not None:
+            self.combine_shards(self.integrator.collect(repetition), *repetition)
+
+    def run_repetitions(self):
         # repeat until all repetitions have been processed
         while not self.stop and not self.is_simulation_finished():
             start_time = time.time()
             self.set_next_rep()
 
-            # TODO I don't think both loops are needed. Merge them?
-            # repeat until current repetition is finished
-            while not self.stop and not self.is_repetition_finished():
-                time.sleep(self.manager_sleep_time)  # pull me off the processor so others can work
+            # wait until current repetition is finished
+            with self.state_changed:
+                while not self.stop and not self.is_repetition_finished():
+                    self.state_changed.wait()
 
-            # wait until jobBuffer is empty
-            while not self.stop and len(self.job_buffer) != 0:
-                time.sleep(self.manager_sleep_time)
+            # wait until every job in the jobBuffer has been recorded
+            self.job_buffer.wait_drained()
+            self.combine_integration()
 
             dur = time.time() - start_time
             self.log("{} {} finished in {} seconds".format(self.repetition_name, self.repetitions_finished, dur))
+            self.log("jobBuffer peaked at {} jobs".format(self.job_buffer.high_water))
+            self.job_buffer.reset_high_water()
 
             if not self.stop:
                 self.repetitions_finished += 1
+                self.take_snapshot()
 
-        self.stop = True
-        self.close_servers()
-        self.log("Ending simulationManagementThread")
+    # Keeps up to repetitions_in_flight repetitions running, starting the
+    # next one whenever one has been answered and integrated.
+    def run_overlapping_repetitions(self):
+        next_index = self.repetitions_finished
+        while not self.stop:
+            while (len(self.active_repetitions) < self.repetitions_in_flight
+                   and not self.is_simulation_finished(next_index)):
+                self.start_repetition(next_index)
+                next_index += 1
+            if not self.active_repetitions:
+                break
+
+            with self.state_changed:
+                while not self.stop:
+                    finished = [index for index in list(self.active_repetitions)
+                                if self.is_repetition_finished(index)]
+                    if finished:
+                        break
+                    self.state_changed.wait()
+            if self.stop:
+                break
+
+            # Jobs of later repetitions may already be in the jobBuffer, only
+            # the ones recorded so far have to be integrated.
+            self.job_buffer.wait_integrated(self.job_buffer.mark())
+            for index in finished:
+                with self.task_gen_lock:
+                    repetition = self.active_repetitions.pop(index)
+                self.combine_integration(index)
+                self.finish_repetition(index)
+                dur = time.time() - repetition.started_at
+                self.log("{} {} finished in {} seconds".format(self.repetition_name, index, dur))
+                self.repetitions_finished += 1
+            # Only with nothing in flight does the user state match a known
+            # number of finished repetitions.
+            if not self.active_repetitions:
+                self.take_snapshot()
+
+    def start_repetition(self, index):
+        self.set_next_repetition(index)
+        self.reset_responses(index)
+        with self.task_gen_lock:
+            self.active_repetitions[index] = Repetition(index, self.task_generator(index))
+        self.replay_checkpoint(index)
+        self.notify_tasks_available()
+
+    # Restores the state saved in the checkpoint and loads the responses
+    # logged since, to be replayed as their repetitions start.
+    def resume_from_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        snapshot, entries = self.checkpoint.load()
+        if snapshot is not None:
+            self.repetitions_finished = snapshot["repetitions_finished"]
+            self.restore_checkpoint_state(snapshot["state"])
+        for entry in entries:
+            kind, index, tasks, response = entry
+            if index < self.repetitions_finished:
+                continue
+            self.replay_entries.setdefault(index, []).append(entry)
+            if kind == "task":
+                tasks = [tasks]
+            self.completed_tasks.setdefault(index, set()).update(task[0] for task in tasks)
+        if snapshot is not None or entries:
+            self.log("Resuming from {} {} with {} logged responses".format(
+                self.repetition_name, self.repetitions_finished, len(entries)))
+        self.checkpoint.start()
+
+    # Records the responses logged for a repetition by an earlier run.
+    def replay_checkpoint(self, index):
+        repetition = None if self.repetitions_in_flight <= 1 else index
+        for kind, index, tasks, response in self.replay_entries.pop(index, []):
+            if kind == "task":
+                self.deliver_response(tasks, response, repetition)
+            elif repetition is None:
+                self.record_combined_response(tasks, response)
+            else:
+                self.record_combined_response(tasks, response, repetition)
+        self.notify_state_changed()
+
+    # Saves the user state once snapshot_interval has passed. Must only be
+    # called while no responses are being recorded.
+    def take_snapshot(self):
+        if self.checkpoint is None:
+            return
+        if self.checkpoint.snapshot_due() or self.is_simulation_finished(*self.repetition_args()):
+            self.checkpoint.snapshot({"repetitions_finished": self.repetitions_finished,
+                                      "state": self.checkpoint_state()})
+            # Only the finished repetitions are in the snapshot. Later ones
+            # still replay their logged results and must skip those tasks, so
+            # their entries are logged again to outlive the old log.
+            for index in list(self.completed_tasks):
+                if index < self.repetitions_finished:
+                    del self.completed_tasks[index]
+            for index in sorted(self.replay_entries):
+                for entry in self.replay_entries[index]:
+                    self.checkpoint.append(entry)
+
+    def repetition_args(self):
+        if self.repetitions_in_flight <= 1:
+            return ()
+        return (self.repetitions_finished,)
+
+    # Queues a recorded response for the checkpoint log. kind is "task" for
+    # the response to a single task or "combined" for a combined response.
+    def log_response(self, kind, tasks, response, repetition):
+        if self.checkpoint is None:
+            return
+        if repetition is None:
+            repetition = self.repetitions_finished
+        self.checkpoint.append((kind, repetition, tasks, response))
 
     # Closes all server connections.
     def close_servers(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
         for server in self.servers:
             try:
                 server.close()
@@ -181,134 +525,757 @@ class DistributedTaskManager:
         for i in range(self.num_job_integrators):
             job_thread = threading.Thread(target=self.job_integration_thread)
             job_thread.start()
-
-    # This thread pops up to 'jobsToPop' synchronously from the jobBuffer.
-    # After it has a set of jobs to integrate it releases the lock
+            self.job_threads.append(job_thread)
+
+    # Waits for the jobIntegration threads to end and for the messages being
+    # handled, so nothing is recorded, logged or traced once it returns. Must
+    # be called after request_stop.
+    def wait_for_handlers(self):
+        for job_thread in self.job_threads:
+            job_thread.join()
+        with self.messages_done:
+            while self.messages_in_progress:
+                self.messages_done.wait()
+
+    # This thread waits for jobs and drains up to 'jobsToPop' at a time from
+    # the jobBuffer.
     def job_integration_thread(self):
         while not self.stop:
-            jobs = []
-            jobs_popped = 0
-
-            if len(self.job_buffer) != 0:
-                with self.responseLock:
-                    while jobs_popped < self.jobs_to_pop and len(self.job_buffer) != 0:
-                        jobs.append(self.job_buffer.pop())
-                        jobs_popped += 1
-
-            for job in jobs:
-                self.record_job(job)
-
-                # Calls user defined setNextRepetition and resetResponses, then resets the
-                # taskGenerator
-                # TODO should this exist or should the user be charged with this in the
-                # set nextRepetition function?
+            if self.tracer is not None:
+                jobs = self.trace_waits(self.job_buffer.pop_batch(self.jobs_to_pop, True))
+            else:
+                jobs = self.job_buffer.pop_batch(self.jobs_to_pop)
 
+            start_time = time.time()
+            if self.integrator is not None:
+                self.integrator.submit(jobs)
+                self.trace("integrate", start_time, {"jobs": len(jobs)})
+            else:
+                for job in jobs:
+                    job_start = time.time()
+                    self.record_job(job)
+                    self.trace("record_job", job_start)
+            if jobs:
+                self.metrics.integrated(len(jobs), time.time() - start_time)
+
+            self.job_buffer.task_done(len(jobs))
+            self.notify_state_changed()
+
+    # Records how long each of a timed batch of jobs waited in the
+    # jobBuffer and returns the jobs.
+    def trace_waits(self, batch):
+        now = time.time()
+        for enqueued_at, job in batch:
+            if enqueued_at is not None:
+                self.tracer.wait("jobBuffer", "coordinator", enqueued_at, now)
+        return [job for enqueued_at, job in batch]
+
+    # Records a span of the calling thread from start until now when
+    # tracing.
+    def trace(self, name, start, args=None):
+        if self.tracer is not None:
+            self.tracer.span(name, "coordinator", start, args=args)
+
+    # Periodically looks for jobs that missed their deadline and clients
+    # that stopped sending heartbeats.
+    def health_monitor_thread(self):
+        intervals = [self.heartbeat_interval, self.min_job_deadline / 2.0]
+        if self.affinity_lookahead > 0:
+            intervals.append(self.affinity_delay)
+        intervals = [interval for interval in intervals if interval > 0]
+        if not intervals:
+            return
+        while not self.stop or self.heartbeat_sessions():
+            time.sleep(min(intervals))
+            self.check_health()
+
+    # Whether any connected client sends heartbeats. After the manager stops
+    # the monitor keeps going until they have all gone, since one that froze
+    # while running a job is only let go once it has been silent for too
+    # long.
+    def heartbeat_sessions(self):
+        with self.jobs_lock:
+            return any(session.connection.heartbeat_interval > 0 for session in self.sessions)
+
+    def check_health(self):
+        now = time.time()
+        expired = []
+        with self.jobs_lock:
+            for job in list(self.outstanding_jobs.values()):
+                if job.deadline is not None and now > job.deadline:
+                    del self.outstanding_jobs[job.job_id]
+                    for session in job.sessions:
+                        session.cancel(job.job_id)
+                        session.healthy = False
+                    if job.partials is not None:
+                        self.return_partials(job)
+                    expired.append(job)
+            silent = []
+            if self.heartbeat_interval > 0:
+                silent = [session for session in self.sessions if session.is_silent(self.heartbeat_timeout, now)]
+
+        for job in expired:
+            peers = ", ".join(session.peer_name for session in job.sessions)
+            self.log("Job {} missed its deadline on {}, requeueing it.".format(job.job_id, peers))
+            if job.partials is None:
+                self.requeue_tasks(job.tasks, job.repetition)
+            else:
+                self.notify_tasks_available()
+        # Wake idle clients to take tasks that waited long enough for theirs.
+        if self.affinity_lookahead > 0 and self.affinity.overdue(now, self.affinity_delay):
+            self.notify_tasks_available()
+        for session in silent:
+            self.log("{} stopped sending heartbeats, disconnecting.".format(session.peer_name))
+            # The engine serving the session sees the connection fail and
+            # drops it.
+            session.connection.abort()
+
+    # Calls user defined setNextRepetition and resetResponses, then resets the
+    # taskGenerator
+    # TODO should this exist or should the user be charged with this in the
+    # set nextRepetition function?
     def set_next_rep(self):
         self.set_next_repetition()
         self.reset_responses()
-        self.task_gen = self.task_generator()
+        with self.task_gen_lock:
+            self.task_gen = self.task_generator()
+            self.read_ahead.clear()
+            self.task_gen_exhausted = False
+        self.replay_checkpoint(self.repetitions_finished)
+        self.notify_tasks_available()
+
+    # Stops the manager and wakes every thread that is waiting on it.
+    def request_stop(self):
+        self.stop = True
+        self.notify_state_changed()
+        self.job_buffer.close()
+        self.notify_tasks_available()
+
+    def notify_state_changed(self):
+        with self.state_changed:
+            self.state_changed.notify_all()
+
+    def notify_tasks_available(self):
+        with self.tasks_available:
+            self.task_epoch += 1
+            self.tasks_available.notify_all()
+        for listener in list(self.task_listeners):
+            listener()
+
+    # Blocks until new tasks may have become available since task_epoch had
+    # the given value.
+    def wait_for_tasks(self, epoch):
+        with self.tasks_available:
+            while not self.stop and self.task_epoch == epoch:
+                self.tasks_available.wait()
 
     # Updates connected count asynchronously.
     def change_connected_count(self, diff):
         with self.connected_lock:
             self.connected += diff
 
-    # Sends client instructions to the client.
+    # Sends client instructions to the client and returns the connection
+    # using the negotiated wire protocol.
     def setup_client(self, sock):
         # TODO do the labels really need to be there?
         client_instructions = str([self.client_labels, self.client_code])
         # Send size of code
         sock.send(str(len(client_instructions)).zfill(self.small_message_size))
-        sock.recv(self.small_message_size)
+        reply = sock.recv(self.small_message_size)
+        # Framed clients answer with FRAMED_MAGIC instead of "CONFIRMED".
+        if reply and FRAMED_MAGIC.startswith(reply):
+            missing = len(FRAMED_MAGIC) - len(reply)
+            if missing:
+                reply += bytes(receive_exactly(sock, missing))
+            return self.negotiate_client(sock, client_instructions)
+        if "legacy" not in self.codecs:
+            raise socket.error("Client does not support any of the codecs {}".format(self.codecs))
         # Send instructions
-        sock.send(client_instructions)
+        sock.sendall(client_instructions)
         sock.recv(self.small_message_size)
+        return LegacyConnection(sock, self.small_message_size, MSG_RESULT)
+
+    # Completes the handshake with a client that offered the framed protocol.
+    def negotiate_client(self, sock, client_instructions):
+        connection = FramedConnection(sock)
+        msg_type, _, payload, _ = connection.receive()
+        if msg_type != MSG_HELLO:
+            raise socket.error("Expected hello from client")
+        hello = decode_handshake(payload)
+        protocol = "legacy"
+        if self.wire_protocol == "framed" and "framed" in hello.get("protocols", []):
+            protocol = "framed"
+        codec = self.choose_codec(hello.get("codecs", ["legacy"]), protocol)
+        heartbeat_interval = 0
+        if protocol == "framed" and hello.get("heartbeats"):
+            heartbeat_interval = self.heartbeat_interval
+        combine = self.client_combines(codec, protocol)
+        setup = {"protocol": protocol, "codec": codec.name, "instructions": client_instructions,
+                 "modules": self.client_modules, "code_hash": self.code_hash(),
+                 "heartbeat_interval": heartbeat_interval, "combine": combine,
+                 "trace": self.tracer is not None and protocol == "framed"}
+        # A client that has the bundle compiled already only needs its hash.
+        if self.code_hash() in hello.get("code_hashes", []):
+            setup["instructions"] = None
+            setup["modules"] = []
+        connection.send(MSG_SETUP, 0, encode_handshake(setup))
+        if protocol == "legacy":
+            connection = LegacyConnection(sock, self.small_message_size, MSG_RESULT)
+        connection.codec = codec
+        connection.heartbeat_interval = heartbeat_interval
+        if codec.structured:
+            connection.parallelism = max(1, int(hello.get("parallelism", 1)))
+        if protocol == "framed":
+            connection.prefetch = max(0, int(hello.get("prefetch", 0)))
+            connection.code_hashes = hello.get("code_hashes", [])
+            connection.client_codecs = hello.get("codecs", ["legacy"])
+        connection.combine = combine
+        return connection
+
+    # Whether a client talking over protocol with codec should combine the
+    # responses to its jobs. Combined responses and reduce jobs need a
+    # structured codec, and reduce jobs are marked with metadata only framed
+    # connections carry.
+    def client_combines(self, codec, protocol):
+        return (self.client_combining and protocol == "framed" and codec.structured
+                and "combine" in eval(self.client_labels))
+
+    # The codec the jobs of this manager are encoded with for session, and
+    # whether its client combines their responses. A WorkloadManager
+    # negotiates both for each of its workloads, otherwise they are the
+    # connection's.
+    def job_codec(self, session):
+        return session.workload_codecs.get(self, session.codec)
+
+    def combines(self, session):
+        return session.workload_combining.get(self, session.combining)
+
+    # Picks the first preferred codec that both sides support and that works
+    # over the negotiated protocol.
+    def choose_codec(self, client_codecs, protocol):
+        for name in self.codecs:
+            if name in client_codecs and name in available_codecs():
+                codec = get_codec(name)
+                if protocol == "framed" or not codec.requires_framing:
+                    return codec
+        raise socket.error("Client does not support any of the codecs {}".format(self.codecs))
 
     # Reads the instructions for the client and send them to the 
     def read_in_client_code(self):
-        f = open("ClientCode.py", "r")
+        f = open(self.client_code_path, "r")
         client_code_lines = f.readlines()
         self.client_labels = client_code_lines[0]
         # line 1 is the delimiter
         self.client_code = ''.join(client_code_lines[2:])
 
+    # Adds a module the client code can import. The source is read from
+    # path unless given. Modules are run on the clients in the order they
+    # were added, so a module can only import the ones added before it.
+    def add_client_module(self, name, path=None, source=None):
+        if source is None:
+            with open(path, "r") as f:
+                source = f.read()
+        self.client_modules.append((name, source))
+        self.client_code_hash = None
+
+    # Identifies the client code bundle, labels, code and modules together.
+    def code_hash(self):
+        if self.client_code_hash is None:
+            self.client_code_hash = bundle_hash(self.client_labels, self.client_code, self.client_modules)
+        return self.client_code_hash
+
+    # Adds a read-only object shared by many tasks and returns the handle
+    # for tasks to carry in its place. Each client is sent the object once,
+    # ahead of the first job that refers to it. Needs a structured codec.
+    def put(self, value):
+        return self.object_store.put(value)
+
+    # Drops an object from the coordinator and the clients once it has been
+    # released as many times as it was put. No task that refers to it may be
+    # handed out or still be unanswered by then.
+    def release(self, handle):
+        if not self.object_store.release(handle):
+            return
+        with self.jobs_lock:
+            for session in self.sessions:
+                if handle in session.objects_sent:
+                    session.objects_sent.discard(handle)
+                    session.object_queue = [entry for entry in session.object_queue if entry[0] != handle]
+                    session.object_queue.append((handle, True))
+
+    # Notes the objects the tasks of a job sent to session refer to that the
+    # client doesn't have yet.
+    def queue_objects(self, session, tasks):
+        handles = self.object_store.referenced([task[1] for task in tasks])
+        if not handles:
+            return
+        if session.connection.protocol != "framed":
+            raise socket.error("Shared objects can only be sent over the framed protocol")
+        with self.jobs_lock:
+            for handle in handles - session.objects_sent:
+                session.objects_sent.add(handle)
+                session.object_queue.append((handle, False))
+
+    # Returns the (msg_type, job_id, payload, meta) frames to send before the
+    # next job of session.
+    def pending_frames(self, session):
+        with self.jobs_lock:
+            queued, session.object_queue = session.object_queue, []
+        frames = []
+        for handle, release in queued:
+            if release:
+                frames.append((MSG_OBJECT, 0, b"", {"object": handle, "release": True}))
+            else:
+                frames.append((MSG_OBJECT, 0, self.object_store.data(handle), {"object": handle}))
+        return frames
+
+    # Returns the metrics as a dict: per worker counters and rates, round
+    # trip and compute time histograms, integration busy time, queue depths
+    # and the number of connected clients.
+    def metrics_snapshot(self):
+        return self.metrics.snapshot(self.metrics_gauges())
+
+    def metrics_gauges(self):
+        with self.task_gen_lock:
+            dropped = len(self.drop_buffer) + sum(len(repetition.drop_buffer)
+                                                  for repetition in self.active_repetitions.values())
+        return {"connected_workers": self.connected, "job_buffer_depth": len(self.job_buffer),
+                "drop_buffer_depth": dropped, "outstanding_jobs": len(self.outstanding_jobs)}
+
     # Thread that handles distributing jobs to its connection
     def client_communication_thread(self, sock):
         self.change_connected_count(1)
+        peer_name = str(sock.getpeername())
 
         # Setup the client
         try:
-            self.setup_client(sock)
-        except socket.error, err:
-            self.log("[ERROR] {}\n".format(err.message))
+            connection = self.setup_client(sock)
+        except socket.error as err:
+            self.log("[ERROR] {}\n".format(err))
             sock.close()
+            self.change_connected_count(-1)
             return
 
+        self.serve_connection(connection, peer_name)
+
+    # Distributes jobs over an established connection until the manager stops
+    # or the client drops.
+    def serve_connection(self, connection, peer_name):
+        session = self.open_session(connection, peer_name)
+
         # Issue jobs to client
         while not self.stop:
-            # Package up tasks into jobs
-            to_client, tasks_in_job = self.get_packaged_job()
-            if to_client == "":
-                continue
-
-            # Send, receive, and handle jobs
             try:
-                send_large_message(sock, to_client, self.small_message_size)
-                responses = receive_large_message(sock, self.small_message_size)
-                self.handle_responses(tasks_in_job, responses)
+                epoch = self.task_epoch
+                # Keep the window of outstanding jobs full.
+                while session.has_room():
+                    job = self.next_job(session)
+                    if job is None:
+                        break
+                    start_time = time.time()
+                    for frame in self.pending_frames(session):
+                        connection.send(*frame)
+                    connection.send(MSG_JOB, *job)
+                    self.trace("send", start_time, {"job": job[0]})
+                # Keep listening while expired jobs may still be answered.
+                if not session.outstanding and not session.cancelled:
+                    self.wait_for_tasks(epoch)
+                    continue
+
+                # Receive and handle whichever job finishes next
+                self.receive_message(session, *connection.receive())
             except Exception as err:
-                self.log(err)
-                # Clean up remainder of job
-                peer_name = str(sock.getpeername())
-                self.log("{} has dropped!".format(peer_name))
-                self.log("Dropped jobs will be added to the drop buffer.")
-                if tasks_in_job != [None]:
-                    for task in tasks_in_job:
-                        self.drop_buffer.append(task)
+                self.drop_session(session, err)
                 break
+        self.close_session(session)
         try:
-            sock.send("Close")
-            sock.close()
+            connection.send(MSG_CLOSE, 0)
+            connection.close()
         except:
             pass
         self.change_connected_count(-1)
         self.log("Ending clientCommunicationThread")
 
+    def open_session(self, connection, peer_name):
+        session = ClientSession(self, connection, peer_name)
+        with self.jobs_lock:
+            self.sessions.add(session)
+        return session
+
+    def close_session(self, session):
+        with self.jobs_lock:
+            self.sessions.discard(session)
+        # Tasks kept for the client can go to anyone now.
+        if session.affinity_keys:
+            self.affinity.forget(session)
+            session.affinity_keys = set()
+            self.notify_tasks_available()
+
+    # Packages up the next job for a session. Returns (job_id, payload, meta),
+    # or None if there are no tasks to hand out right now or the jobBuffer is
+    # full.
+    def next_job(self, session):
+        job = self.choose_job(session)
+        if job is not None:
+            self.metrics.job_sent(session.peer_name, payload_size(job[1]))
+        return job
+
+    def choose_job(self, session):
+        if self.job_buffer.full():
+            return None
+        # Reducing full groups of combined responses first keeps them from
+        # piling up on the coordinator.
+        job = self.reduce_job(session, self.reduction_fan_in)
+        if job is not None:
+            return job
+        to_client, tasks_in_job, repetition = self.package_job(self.job_codec(session), session.job_size(), session)
+        if not tasks_in_job:
+            self.flush_partials(session)
+            return self.reduce_job(session, 2) or self.speculative_job(session)
+        job = Job(next(self.job_ids), tasks_in_job, repetition)
+        job.sessions.add(session)
+        with self.jobs_lock:
+            job.deadline = self.job_deadline(session, len(tasks_in_job))
+            self.outstanding_jobs[job.job_id] = job
+            session.job_sent(job.job_id, tasks_in_job)
+        self.queue_objects(session, tasks_in_job)
+        return job.job_id, to_client, None
+
+    # Packages up to reduction_fan_in combined responses of one repetition
+    # into a job for a combining client to reduce, or returns None if no
+    # repetition has at least minimum of them waiting.
+    def reduce_job(self, session, minimum):
+        if not self.combines(session) or self.reduction_fan_in < 2:
+            return None
+        with self.jobs_lock:
+            for repetition, partials in self.partials.items():
+                if len(partials) >= minimum:
+                    taken = partials[:self.reduction_fan_in]
+                    del partials[:self.reduction_fan_in]
+                    break
+            else:
+                return None
+            job = Job(next(self.job_ids), [task for tasks, response in taken for task in tasks], repetition)
+            job.partials = taken
+            job.sessions.add(session)
+            job.deadline = self.job_deadline(session, len(taken))
+            self.outstanding_jobs[job.job_id] = job
+            session.job_sent(job.job_id, taken)
+        return job.job_id, self.job_codec(session).encode([response for tasks, response in taken]), {"reduce": True}
+
+    # Puts the combined responses of a reduce job that won't be answered back
+    # with the others. Must be called with jobs_lock held.
+    def return_partials(self, job):
+        self.partials.setdefault(job.repetition, []).extend(job.partials)
+
+    # Records the combined responses of every repetition with nothing left
+    # to hand out or wait for, unless a combining client can still reduce
+    # them. Called when there are no tasks to hand out.
+    def flush_partials(self, session):
+        ready = []
+        with self.jobs_lock:
+            busy = set(job.repetition for job in self.outstanding_jobs.values())
+            reducers = any(self.combines(other) for other in self.sessions)
+            for repetition in list(self.partials):
+                partials = self.partials[repetition]
+                if repetition in busy or (len(partials) > 1 and reducers and self.reduction_fan_in >= 2):
+                    continue
+                ready.append((repetition, partials))
+                del self.partials[repetition]
+        for repetition, partials in ready:
+            for tasks, response in partials:
+                self.record_combined(tasks, response, repetition)
+
+    # Records a combined response right away, or keeps it to be reduced
+    # further.
+    def add_partial(self, tasks, response, repetition):
+        if self.reduction_fan_in < 2:
+            self.record_combined(tasks, response, repetition)
+            return
+        with self.jobs_lock:
+            self.partials.setdefault(repetition, []).append((tasks, response))
+        self.notify_tasks_available()
+
+    def record_combined(self, tasks, response, repetition=None):
+        self.log_response("combined", tasks, response, repetition)
+        start_time = time.time()
+        if repetition is None:
+            self.record_combined_response(tasks, response)
+        else:
+            self.record_combined_response(tasks, response, repetition)
+        self.trace("record_combined_response", start_time, {"tasks": len(tasks)})
+        self.notify_state_changed()
+
+    # Copies the oldest outstanding job onto an idle session, or returns None
+    # if speculation is off or there is nothing worth copying.
+    def speculative_job(self, session):
+        # A client still running a cancelled copy isn't idle.
+        if not self.speculative_execution or session.outstanding or session.cancelled:
+            return None
+        with self.jobs_lock:
+            for job in self.outstanding_jobs.values():
+                if (job.partials is None and session not in job.sessions
+                        and len(job.sessions) < self.max_job_copies):
+                    job.sessions.add(session)
+                    session.job_sent(job.job_id, job.tasks)
+                    break
+            else:
+                return None
+        self.queue_objects(session, job.tasks)
+        return job.job_id, self.job_codec(session).encode([task[1] for task in job.tasks]), None
+
+    # Returns the time by which a job of task_count tasks sent to session now
+    # must be answered, or None if there is no deadline.
+    def job_deadline(self, session, task_count):
+        if self.deadline_factor <= 0:
+            return None
+        expected = session.expected_duration(task_count, self.task_time)
+        if expected is None:
+            return None
+        return time.time() + max(self.min_job_deadline, self.deadline_factor * expected)
+
+    # Passes a message received from a session's client to handle_message,
+    # counting it as in progress until it has been handled.
+    def receive_message(self, session, msg_type, job_id, responses, meta):
+        with self.messages_done:
+            self.messages_in_progress += 1
+        try:
+            self.handle_message(session, msg_type, job_id, responses, meta)
+        finally:
+            with self.messages_done:
+                self.messages_in_progress -= 1
+                if not self.messages_in_progress:
+                    self.messages_done.notify_all()
+
+    # Handles a message received from a session's client.
+    def handle_message(self, session, msg_type, job_id, responses, meta):
+        session.heard_from()
+        if msg_type == MSG_HEARTBEAT:
+            return
+        if msg_type != MSG_RESULT:
+            raise socket.error("Unexpected message {} for job {}".format(msg_type, job_id))
+        with self.jobs_lock:
+            if job_id in session.cancelled:
+                # Another client answered this job first, or it missed its
+                # deadline. Either way the client is alive.
+                session.cancelled.discard(job_id)
+                session.healthy = True
+                return
+            if job_id not in session.outstanding:
+                raise socket.error("Unexpected result for job {}".format(job_id))
+            answered = time.time()
+            sent_at = session.sent_at[job_id]
+            job = self.outstanding_jobs[job_id]
+            # Reduce jobs say nothing about how long tasks take, and may be
+            # the first a session answers.
+            timed = job.partials is None
+            session.job_finished(job_id, meta, timed)
+            if timed and session.task_time is not None:
+                self.task_time = smooth(self.task_time, session.task_time)
+            del self.outstanding_jobs[job_id]
+            for other in job.sessions:
+                if other is not session:
+                    other.cancel(job_id)
+        compute = meta.get("compute") if meta else None
+        self.metrics.job_answered(session.peer_name, len(job.tasks), payload_size(responses),
+                                  answered - sent_at, compute)
+        if self.tracer is not None and meta and "trace" in meta:
+            self.tracer.client_spans(session.peer_name, job_id, sent_at, answered, meta["trace"])
+        codec = self.job_codec(session)
+        if job.partials is not None or self.combines(session):
+            try:
+                response = codec.decode(responses)[0]
+            except Exception:
+                # The job is gone from the session, so hand out what it was
+                # for again before the session is dropped.
+                with self.jobs_lock:
+                    self.requeue_job(job)
+                raise
+            self.add_partial(job.tasks, response, job.repetition)
+        else:
+            self.handle_responses(job.tasks, responses, codec, job.repetition)
+        self.trace("receive", answered, {"job": job_id})
+
+    # Cleans up after a client that dropped, requeueing the jobs that were
+    # still outstanding and aren't running on another client.
+    def drop_session(self, session, err):
+        self.log(err)
+        self.log("{} has dropped!".format(session.peer_name))
+        self.log("Dropped jobs will be added to the drop buffer.")
+        with self.jobs_lock:
+            self.sessions.discard(session)
+            self.release_jobs(session)
+
+    # Requeues the jobs outstanding on a session that aren't running on
+    # another client. Jobs of other managers are left alone. Must be called
+    # with jobs_lock held.
+    def release_jobs(self, session):
+        for job_id in list(session.outstanding):
+            job = self.outstanding_jobs.get(job_id)
+            if job is None:
+                continue
+            del session.outstanding[job_id]
+            job.sessions.discard(session)
+            if not job.sessions:
+                del self.outstanding_jobs[job_id]
+                self.requeue_job(job)
+
+    # Hands the tasks or partials of a job that nobody will answer out again.
+    # Must be called with jobs_lock held.
+    def requeue_job(self, job):
+        if job.partials is None:
+            self.requeue_tasks(job.tasks, job.repetition)
+        else:
+            self.return_partials(job)
+            self.notify_tasks_available()
+
         # Pulls the next task from the user-defined taskGenerator.
         # After all original tasks are used, this pulls from the dropBuffer
         # until the dropBuffer is empty at which point the function returns
         # None, signaling the receiving clientCommunicationThread to wait.
 
+    # Tasks found in the result cache are recorded straight away and skipped.
     def get_next_task(self):
-        with self.task_gen_lock:
+        while True:
+            start_time = time.time()
+            with self.task_gen_lock:
+                task = self.next_generated_task()
+                if task is None and len(self.drop_buffer) != 0:
+                    task = self.drop_buffer.pop()
+            if task is not None:
+                self.trace("generate", start_time, {"task": task[0]})
+            if task is None or not self.skip_task(task):
+                return task
+
+    # Returns the next task of the task generator, or None once it has run
+    # out. Must be called with task_gen_lock held.
+    def next_generated_task(self):
+        if self.adaptive_batching:
+            self.fill_read_ahead()
+        if self.read_ahead:
+            return self.read_ahead.popleft()
+        return next(self.task_gen, None)
+
+    # Tops the read-ahead buffer up to read_ahead_size tasks. Must be called
+    # with task_gen_lock held.
+    def fill_read_ahead(self):
+        while not self.task_gen_exhausted and len(self.read_ahead) < self.read_ahead_size:
             task = next(self.task_gen, None)
-            if task is None and len(self.drop_buffer) != 0:
-                return self.drop_buffer.pop()
+            if task is None:
+                self.task_gen_exhausted = True
             else:
-                return task
+                self.read_ahead.append(task)
+
+    # Returns True if the task needn't be sent out because an earlier run
+    # answered it or its response is in the result cache, which is recorded.
+    def skip_task(self, task, repetition=None):
+        index = self.repetitions_finished if repetition is None else repetition
+        if task[0] in self.completed_tasks.get(index, ()):
+            return True
+        return self.answer_from_cache(task, repetition)
+
+    # Records the cached response to a task if there is one. Returns whether
+    # the task was answered.
+    def answer_from_cache(self, task, repetition=None):
+        if self.result_cache is None:
+            return False
+        found, response = self.result_cache.get(self.cache_key(task))
+        if not found:
+            return False
+        self.log_response("task", task, response, repetition)
+        self.deliver_response(task, response, repetition)
+        self.notify_state_changed()
+        return True
+
+    # Hands the response to a task to record_response.
+    def deliver_response(self, task, response, repetition=None):
+        start_time = time.time()
+        if repetition is None:
+            self.record_response(task, response)
+        else:
+            self.record_response(task, response, repetition)
+        self.trace("record_response", start_time, {"task": task[0]})
+
+    def cache_key(self, task):
+        return self.result_cache.key(self.code_hash(), task[1])
 
-    # Returns a package with multiple tasks as a string.
-    # The structure of a package is task descriptions seperated by underscores.
-    # TODO should this be pushed on the user to define?
-    def get_packaged_job(self, ):
-        to_client = ""
-        tasks_in_job = []
-        for i in range(self.tasks_per_job):
+    # Places the tasks of an unfinished job in the dropBuffer of their
+    # repetition so they are handed out again.
+    def requeue_tasks(self, tasks, repetition=None):
+        with self.task_gen_lock:
+            if repetition in self.active_repetitions:
+                self.active_repetitions[repetition].drop_buffer.extend(tasks)
+            else:
+                self.drop_buffer.extend(tasks)
+        self.notify_tasks_available()
+
+    # Takes up to count tasks belonging to a single repetition. Returns the
+    # index of the repetition, None unless repetitions overlap, and the tasks.
+    # Given the session the tasks are for, tasks are picked by affinity.
+    def take_tasks(self, count, session=None):
+        if self.affinity_lookahead > 0 and session is not None:
+            return self.affinity.take(session, count, self.affinity_lookahead, self.affinity_delay,
+                                      self.next_buffered_task, self.task_affinity)
+        if self.repetitions_in_flight <= 1:
+            tasks = []
+            for i in range(count):
+                task = self.get_next_task()
+                if task is not None:
+                    tasks.append(task)
+            return None, tasks
+        # The oldest repetitions go first so they finish first.
+        while True:
+            start_time = time.time()
+            with self.task_gen_lock:
+                for repetition in self.active_repetitions.values():
+                    tasks = repetition.take(count)
+                    if tasks:
+                        break
+                else:
+                    return None, []
+            self.trace("generate", start_time, {"tasks": len(tasks), "repetition": repetition.index})
+            tasks = [task for task in tasks if not self.skip_task(task, repetition.index)]
+            if tasks:
+                return repetition.index, tasks
+
+    # Returns the next (repetition, task) for the affinity buffer, or None.
+    def next_buffered_task(self):
+        if self.repetitions_in_flight <= 1:
             task = self.get_next_task()
-            if task is not None:
-                tasks_in_job.append(task)
-                # TODO the underscore should be some generic delimiter that the
-                # user can set. If this is changed then also send the delimiter
-                # across to the clients so they can properly parse messages.
-                to_client += "_" + str(task[1])
-        return to_client[1:], tasks_in_job
+            return None if task is None else (None, task)
+        repetition, tasks = self.take_tasks(1)
+        return (repetition, tasks[0]) if tasks else None
+
+    # Returns a package with up to tasks_per_job tasks encoded by the given
+    # codec. With
+    # the legacy codec the package is the task descriptions seperated by
+    # underscores, other codecs send the actual list of task descriptions.
+    def get_packaged_job(self, codec=LEGACY_CODEC, tasks_per_job=None):
+        to_client, tasks_in_job, repetition = self.package_job(codec, tasks_per_job)
+        return to_client, tasks_in_job
+
+    # Like get_packaged_job but also returns the index of the repetition the
+    # tasks belong to.
+    def package_job(self, codec=LEGACY_CODEC, tasks_per_job=None, session=None):
+        if tasks_per_job is None:
+            tasks_per_job = self.tasks_per_job
+        start_time = time.time()
+        repetition, tasks_in_job = self.take_tasks(tasks_per_job, session)
+        if not tasks_in_job:
+            return "", tasks_in_job, repetition
+        to_client = codec.encode([task[1] for task in tasks_in_job])
+        self.trace("package", start_time, {"tasks": len(tasks_in_job)})
+        return to_client, tasks_in_job, repetition
 
     # Records the tasks and corresponding responses by placing them into the jobBuffer.
-    def handle_responses(self, tasks, responses):
-        # loop through a split up responses and place the peices into the jobBuffer
-        split_responses = responses.split("_")
-        for index, response in enumerate(split_responses):
-            self.record_response(tasks[index], response)
+    def handle_responses(self, tasks, responses, codec=LEGACY_CODEC, repetition=None):
+        # loop through the decoded responses and place the peices into the jobBuffer
+        for index, response in enumerate(codec.decode(responses)):
+            if self.result_cache is not None:
+                self.result_cache.put(self.cache_key(tasks[index]), response)
+            self.log_response("task", tasks[index], response, repetition)
+            self.deliver_response(tasks[index], response, repetition)
+        self.notify_state_changed()
 
     # TODO replace with https://docs.python.org/2/library/logging.html
     def log(self, msg):
@@ -319,6 +1286,15 @@ class DistributedTaskManager:
             #    User must overwrite the following functions.    #
             ######################################################
 
+    # When repetitions_in_flight is more than one, is_repetition_finished,
+    # is_simulation_finished, task_generator, reset_responses,
+    # set_next_repetition, record_response, record_combined_response,
+    # collect_shard and combine_shards are given the index of the repetition they concern as their last
+    # argument. is_simulation_finished is then asked whether the repetition
+    # with that index should not be started at all, and record_response
+    # should keep the index with the jobs it makes so record_job can tell the
+    # repetitions apart.
+
     # User defines when a repetition is finished.
     def is_repetition_finished(self, ):
         raise NotImplementedError
@@ -327,11 +1303,32 @@ class DistributedTaskManager:
     def is_simulation_finished(self, ):
         raise NotImplementedError
 
+    # User may define how many tasks the taskGenerator has yet to yield in the
+    # current repetition. With adaptive batching jobs shrink as this nears
+    # zero so the end of a repetition finishes quickly. None means unknown.
+    # By default it is known once the tasks read ahead (see read_ahead)
+    # include the last one, and counts those and the dropped tasks waiting
+    # to be handed out again. Overlapping repetitions aren't read ahead.
+    def estimate_remaining_tasks(self):
+        if self.repetitions_in_flight > 1:
+            return None
+        with self.task_gen_lock:
+            self.fill_read_ahead()
+            if not self.task_gen_exhausted:
+                return None
+            return len(self.read_ahead) + len(self.drop_buffer) + len(self.affinity.entries)
+
     # User defines how the given task is broken up, yielding tasks to be sent
     # to a client, yielding None if there are no more tasks to be given.
     def task_generator(self):
         raise NotImplementedError
 
+    # User may define the affinity keys of a task, the data or warm state
+    # it needs, used when affinity_lookahead is set. By default these are
+    # the shared objects the task refers to.
+    def task_affinity(self, task):
+        return self.object_store.referenced([task[1]])
+
     # TODO Should this just be wrapped up inside the setNextRepetition function?
     # User defines what reseting the responses entails.
     # Note: This function is called at the begining of each repetition.
@@ -355,6 +1352,46 @@ class DistributedTaskManager:
     def record_job(self, job):
         raise NotImplementedError
 
+    # With client combining, user defines how to record a response made by
+    # combining the responses to several tasks with the client's combine
+    # function. tasks are all of the tasks it covers.
+    def record_combined_response(self, tasks, response):
+        raise NotImplementedError
+
+    # With the "processes" integration backend, user defines which shard
+    # records a job. Jobs with equal keys are always recorded by the same
+    # process.
+    def partition_key(self, job):
+        raise NotImplementedError
+
+    # With the "processes" integration backend, user may define what a shard
+    # returns once every job of a repetition has been recorded. It runs in
+    # the shard process, the result must be picklable, and the shard should
+    # forget what it returns.
+    def collect_shard(self):
+        return None
+
+    # With the "processes" integration backend, user may define how the
+    # results of collect_shard, one per shard in shard order, are merged
+    # into the coordinator's state once a repetition is integrated.
+    def combine_shards(self, partials):
+        pass
+
+    # With a checkpoint, user may define the state to save between
+    # repetitions. It must be picklable and is handed to
+    # restore_checkpoint_state when a run is resumed.
+    def checkpoint_state(self):
+        return None
+
+    def restore_checkpoint_state(self, state):
+        pass
+
+    # User may define what to do once a repetition has been answered and all
+    # of its jobs recorded. Only called when repetitions overlap, since
+    # otherwise set_next_repetition is the place for it.
+    def finish_repetition(self, repetition):
+        pass
+
 
 # Client Objects #
 
@@ -366,9 +1403,21 @@ class DistributedTaskManager:
 
 
 class DistributedTaskClient:
-    def __init__(self):
+    # wire_protocol is "framed" to offer the binary framed protocol or
+    # "legacy" to talk to coordinators that only know the "CONFIRMED" handshake.
+    # processes is the number of local worker processes jobs are spread over,
+    # None for one per core. More than one needs a structured codec and a
+    # platform that can fork, otherwise jobs run inline.
+    # prefetch is the number of jobs received and decoded ahead of the one
+    # being computed over a framed connection. Zero handles one job at a time.
+    # code_cache_dir is where compiled client code is kept between
+    # connections so unchanged code isn't sent or compiled again. None
+    # disables the cache.
+    def __init__(self, wire_protocol="framed", processes=1, prefetch=0, code_cache_dir=DEFAULT_CACHE_DIR):
         self.clientSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clientTask = ClientTask()
+        self.clientTask = ClientTask(processes, prefetch, code_cache_dir)
+        self.wire_protocol = wire_protocol
+        self.connection = None
 
     def setup(self, ip, port):
         try:
@@ -379,40 +1428,279 @@ class DistributedTaskClient:
 
         print("Connected to server (%s)" % str(self.clientSock.getpeername()))
 
-        self.clientTask.receive_task_instructions(self.clientSock)
+        self.connection = self.clientTask.receive_task_instructions(self.clientSock, self.wire_protocol)
         self.clientTask.interpret_task_instructions()
+        self.clientTask.start_pool()
 
     def run(self):
-        self.clientTask.run(self.clientSock)
+        self.clientTask.run(self.connection)
 
 
 class ClientTask:
-    def __init__(self):
+    def __init__(self, processes=1, prefetch=0, code_cache_dir=None):
         self.small_message_size = 10
+        self.processes = processes
+        self.prefetch = prefetch
+        # Whether to merge the responses to each job into one with the
+        # combine function of the client code, as told by the coordinator.
+        self.combining = False
+        self.pool = None
+        # Shared objects received from the coordinator.
+        self.objects = ObjectCache()
         self.clientSetupStr = ""
-
+        # Modules and hash of the client code bundle, sent by framed
+        # coordinators only.
+        self.client_modules = []
+        self.code_hash = None
+        # Client code of the workloads of a coordinator serving several,
+        # by code hash, and the code hash, codec and whether to combine of
+        # each workload by name.
+        self.workload_tasks = {}
+        self.workload_hashes = {}
+        self.workload_codecs = {}
+        self.workload_combining = {}
+        self.code_cache = None
+        if code_cache_dir is not None:
+            self.code_cache = CodeCache(code_cache_dir)
+        self.codec = LEGACY_CODEC
+        # Seconds between heartbeats, zero if the coordinator doesn't want them.
+        self.heartbeat_interval = 0
+        # Whether to send the coordinator the spans of every job, as told by
+        # a tracing coordinator.
+        self.tracing = False
+
+    # Compiles the client code, or takes it from the code cache, and binds
+    # the labelled names. The code runs with this module's globals visible
+    # as it always has.
     def interpret_task_instructions(self):
-        instructions = eval(self.clientSetupStr)
-        names = instructions[0]
-        code = instructions[1]
-        exec(code)
-        names = eval(names)
-        for name in names:
-            self.__dict__[name] = eval(name)
-
-    def receive_task_instructions(self, sock):
-        # get instructions
-        self.clientSetupStr = receive_large_message(sock, self.small_message_size)
-        sock.send("CONFIRMED")
-
-    def run(self, sock):
+        labels, code, modules = self.load_bundle()
+        install_modules(modules)
+        namespace = dict(globals())
+        exec(code, namespace)
+        for name in eval(labels):
+            self.__dict__[name] = namespace[name]
+
+    def load_bundle(self):
+        if self.clientSetupStr is None:
+            bundle = None
+            if self.code_cache is not None:
+                bundle = self.code_cache.load(self.code_hash)
+            if bundle is None:
+                raise socket.error("Client code {} is not in the code cache".format(self.code_hash))
+            return bundle
+        labels, code = eval(self.clientSetupStr)
+        if self.code_cache is not None and self.code_hash is not None:
+            return self.code_cache.store(self.code_hash, labels, code, self.client_modules)
+        return compile_bundle(labels, code, self.client_modules)
+
+    # Forks the worker processes once the client code is known. Unstructured
+    # jobs are opaque to the client so they always run inline.
+    def start_pool(self):
+        if self.processes == 1 or not self.codec.structured:
+            return
+        try:
+            self.objects.share()
+            self.pool = WorkerPool(self, self.processes)
+        except (ValueError, OSError) as err:
+            print("Could not start worker processes ({}), running jobs inline.".format(err))
+
+    # Returns the shared object a task refers to by handle. For use by the
+    # client code.
+    def get_object(self, handle):
+        return self.objects.get(handle)
+
+    # Interprets the client code of a workload sent by the coordinator.
+    def receive_workload(self, msg, meta):
+        code = decode_handshake(bytes(msg))
+        modules = [tuple(module) for module in code["modules"]]
+        self.workload_task(meta["code_hash"], code["instructions"], modules)
+        self.workload_hashes[meta["workload"]] = meta["code_hash"]
+        self.workload_codecs[meta["workload"]] = get_codec(code["codec"])
+        self.workload_combining[meta["workload"]] = code["combine"]
+
+    # Returns a ClientTask running the client code identified by code_hash,
+    # sharing this one's codec and objects. Code that wasn't received by
+    # this process is loaded from the code cache.
+    def workload_task(self, code_hash, instructions=None, modules=()):
+        client_task = ClientTask()
+        client_task.code_cache = self.code_cache
+        client_task.codec = self.codec
+        client_task.objects = self.objects
+        client_task.clientSetupStr = instructions
+        client_task.client_modules = list(modules)
+        client_task.code_hash = code_hash
+        client_task.interpret_task_instructions()
+        self.workload_tasks[code_hash] = client_task
+        return client_task
+
+    # Returns the ClientTask for the client code identified by code_hash,
+    # this one if None.
+    def task_for(self, code_hash):
+        if code_hash is None:
+            return self
+        if code_hash not in self.workload_tasks:
+            return self.workload_task(code_hash)
+        return self.workload_tasks[code_hash]
+
+    # Stores or drops a shared object sent by the coordinator.
+    def receive_object(self, msg, meta):
+        if meta.get("release"):
+            self.objects.discard(meta["object"])
+        else:
+            self.objects.add(meta["object"], bytes(msg))
+
+    # Number of tasks this client runs at once.
+    def parallelism(self):
+        if self.processes is None:
+            return multiprocessing.cpu_count()
+        return self.processes
+
+    # Describes this client to the coordinator during the framed handshake.
+    def hello(self):
+        return {"protocols": ["framed", "legacy"], "codecs": available_codecs(), "heartbeats": True,
+                "parallelism": self.parallelism(), "prefetch": self.prefetch,
+                "code_hashes": self.code_cache.hashes() if self.code_cache is not None else []}
+
+    # Returns the code hash, codec and whether to combine for a job, or for
+    # the answer to it, given its metadata. Each workload of a coordinator
+    # serving several has its own.
+    def job_settings(self, meta):
+        if meta and "workload" in meta:
+            workload = meta["workload"]
+            return self.workload_hashes[workload], self.workload_codecs[workload], self.workload_combining[workload]
+        return None, self.codec, self.combining
+
+    def decode_job(self, msg, meta=None):
+        codec = self.job_settings(meta)[1]
+        if not codec.structured:
+            return msg
+        return codec.decode(msg)
+
+    # A job marked reduce holds combined responses to be combined into one.
+    # A job marked with a workload runs that workload's client code.
+    def compute(self, tasks, meta=None):
+        code_hash, codec, combining = self.job_settings(meta)
+        client_task = self.task_for(code_hash)
+        if meta and meta.get("reduce"):
+            return [client_task.fold(tasks)]
+        if self.pool is not None and codec.structured and (code_hash is None or self.code_cache is not None):
+            responses = self.pool.map(tasks, code_hash)
+        else:
+            responses = client_task.task(client_task, tasks)
+        if combining:
+            return [client_task.fold(responses)]
+        return responses
+
+    def fold(self, responses):
+        return functools.reduce(lambda first, second: self.combine(self, first, second), responses)
+
+    # Metadata sent along with the answer to a job. When tracing, spans are
+    # the job's [name, thread, start, end] spans so far, the first of them
+    # starting when the job was received.
+    def result_meta(self, job_meta, compute_time, spans=None):
+        meta = {"compute": compute_time}
+        if job_meta and "workload" in job_meta:
+            meta["workload"] = job_meta["workload"]
+        if self.tracing and spans:
+            meta["trace"] = {"received": spans[0][2], "spans": spans}
+        return meta
+
+    # Adds the span of encoding the answer to a job, which started at
+    # start_time, to its metadata and stamps the time it is sent.
+    def trace_reply(self, meta, start_time, thread):
+        if "trace" in meta:
+            now = time.time()
+            meta["trace"]["spans"].append(["encode", thread, start_time, now])
+            meta["trace"]["replied"] = now
+
+    def encode_responses(self, responses, meta=None):
+        codec = self.job_settings(meta)[1]
+        if not codec.structured:
+            return responses
+        return codec.encode(responses)
+
+    # Receives the task instructions and returns the connection to use for
+    # the rest of the session.
+    def receive_task_instructions(self, sock, wire_protocol="legacy"):
+        if wire_protocol == "legacy":
+            # get instructions
+            self.clientSetupStr = receive_large_message(sock, self.small_message_size)
+            sock.send("CONFIRMED")
+            return LegacyConnection(sock, self.small_message_size, MSG_JOB)
+
+        # The coordinator first announces the size of the legacy instructions,
+        # answering with FRAMED_MAGIC asks it to negotiate instead.
+        receive_exactly(sock, self.small_message_size)
+        sock.sendall(FRAMED_MAGIC)
+        connection = FramedConnection(sock)
+        connection.send(MSG_HELLO, 0, encode_handshake(self.hello()))
+        msg_type, _, payload, _ = connection.receive()
+        if msg_type != MSG_SETUP:
+            raise socket.error("Expected setup from server")
+        setup = decode_handshake(payload)
+        self.clientSetupStr = setup["instructions"]
+        self.client_modules = [tuple(module) for module in setup.get("modules", [])]
+        self.code_hash = setup.get("code_hash")
+        self.heartbeat_interval = setup.get("heartbeat_interval", 0)
+        self.combining = setup.get("combine", False)
+        self.tracing = setup.get("trace", False)
+        self.codec = get_codec(setup.get("codec", "legacy"))
+        if setup["protocol"] == "legacy":
+            self.heartbeat_interval = 0
+            self.tracing = False
+            return LegacyConnection(sock, self.small_message_size, MSG_JOB)
+        return connection
+
+    # Tells the coordinator this client is alive until the connection closes.
+    def send_heartbeats(self, connection, finished):
+        while not finished.wait(self.heartbeat_interval):
+            try:
+                connection.send(MSG_HEARTBEAT, 0)
+            except Exception:
+                break
+
+    def run(self, connection):
+        finished = threading.Event()
+        heartbeat_thread = None
+        if self.heartbeat_interval > 0:
+            heartbeat_thread = threading.Thread(target=self.send_heartbeats, args=(connection, finished))
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+        if self.prefetch > 0 and connection.protocol == "framed":
+            self.run_prefetching(connection)
+        else:
+            self.run_serial(connection)
+        finished.set()
+        # Left running, it can be torn down mid-wait as the interpreter exits.
+        if heartbeat_thread is not None:
+            heartbeat_thread.join()
+        if self.pool is not None:
+            self.pool.close()
+        self.objects.close()
+        connection.close()
+
+    # Receives, computes and answers one job at a time.
+    def run_serial(self, connection):
         while 1:
             try:
-                msg = receive_large_message(sock, self.small_message_size)
-                if msg != "Close":
+                msg_type, job_id, msg, meta = connection.receive()
+                if msg_type == MSG_OBJECT:
+                    self.receive_object(msg, meta)
+                elif msg_type == MSG_CODE:
+                    self.receive_workload(msg, meta)
+                elif msg_type != MSG_CLOSE:
                     # TODO: This should almost certainly be made an abstract function
-                    ans = self.task(self, msg)
-                    send_large_message(sock, ans, self.small_message_size)
+                    start_time = time.time()
+                    tasks = self.decode_job(msg, meta)
+                    compute_start = time.time()
+                    responses = self.compute(tasks, meta)
+                    encode_start = time.time()
+                    ans = self.encode_responses(responses, meta)
+                    spans = [["decode", "main", start_time, compute_start],
+                             ["compute", "main", compute_start, encode_start]]
+                    result_meta = self.result_meta(meta, time.time() - start_time, spans)
+                    self.trace_reply(result_meta, encode_start, "main")
+                    connection.send(MSG_RESULT, job_id, ans, result_meta)
                 else:
                     # TODO change this to a log message
                     print("Received close, disconnecting...")
@@ -422,40 +1710,77 @@ class ClientTask:
                 # TODO change this to a log message
                 print("Error encountered, exiting...")
                 break
-        sock.close()
-
-
-# Helper Functions #
-
-def send_large_message(sock, msg, min_message_size):
-    sock.send(str(len(msg)).zfill(min_message_size))
-    sock.recv(min_message_size)
-    sock.send(msg)
-
-
-# Receives a message from a socket. First receiving the size of the message
-# to be received, looping to receive the entire message in chunks of at
-# most recv_size number of bytes.
-
-def receive_large_message(sock, min_message_size):
-    # get size of message to be received
-    val = sock.recv(min_message_size)
-    if val == "Close":
-        return val
-    incoming_size = int(val)
-    sock.send("CONFIRMED")
-    responses = ""
-    bytes_received = 0
-    # receive message
-    while bytes_received < incoming_size:
-        bytes_remaining = incoming_size - bytes_received
-        if bytes_remaining > 1024:
-            recv_size = 1024
-        else:
-            recv_size = bytes_remaining
-        msg_part = sock.recv(recv_size)
-        bytes_received += len(msg_part)
-        responses += msg_part
-    if responses == '':
-        raise Exception
-    return responses
+
+    # Computes jobs on this thread while one thread receives and decodes the
+    # next prefetch jobs and another encodes and sends finished results, so
+    # computing never waits on the network.
+    def run_prefetching(self, connection):
+        jobs = queue.Queue(self.prefetch)
+        results = queue.Queue()
+        receiver = threading.Thread(target=self.receive_jobs, args=(connection, jobs))
+        receiver.daemon = True
+        receiver.start()
+        sender = threading.Thread(target=self.send_results, args=(connection, results))
+        sender.start()
+        while 1:
+            job = jobs.get()
+            if job is None:
+                break
+            job_id, tasks, meta, spans = job
+            start_time = time.time()
+            try:
+                responses = self.compute(tasks, meta)
+            except:
+                traceback.print_exc()
+                print("Error encountered, exiting...")
+                # Wakes the receiver so it stops as well.
+                connection.abort()
+                break
+            end_time = time.time()
+            spans.append(["compute", "compute", start_time, end_time])
+            results.put((job_id, responses, self.result_meta(meta, end_time - start_time, spans)))
+        results.put(None)
+        sender.join()
+
+    # Feeds decoded jobs into the jobs queue, then None once the connection
+    # closes.
+    def receive_jobs(self, connection, jobs):
+        while 1:
+            try:
+                msg_type, job_id, msg, meta = connection.receive()
+                if msg_type == MSG_CLOSE:
+                    print("Received close, disconnecting...")
+                    break
+                if msg_type == MSG_OBJECT:
+                    self.receive_object(msg, meta)
+                    continue
+                if msg_type == MSG_CODE:
+                    self.receive_workload(msg, meta)
+                    continue
+                start_time = time.time()
+                tasks = self.decode_job(msg, meta)
+                jobs.put((job_id, tasks, meta, [["decode", "receive", start_time, time.time()]]))
+            except:
+                traceback.print_exc()
+                print("Error encountered, exiting...")
+                break
+        jobs.put(None)
+
+    # Encodes and sends results from the results queue until it yields None.
+    def send_results(self, connection, results):
+        while 1:
+            result = results.get()
+            if result is None:
+                return
+            job_id, responses, meta = result
+            try:
+                start_time = time.time()
+                payload = self.encode_responses(responses, meta)
+                self.trace_reply(meta, start_time, "send")
+                connection.send(MSG_RESULT, job_id, payload, meta)
+            except:
+                traceback.print_exc()
+                print("Error encountered, exiting...")
+                # Wakes the receiver so the compute loop stops as well.
+                connection.abort()
+                return
@@ -0,0 +1,232 @@
+import collections
+import errno
+import select
+import socket
+import threading
+import time
+
+from .protocol import MSG_JOB, MSG_CLOSE, FrameReader, byte_view, frame_buffers, pack_header
+
+
+# Event Loop Engine #
+
+# Serves every framed connection of a DistributedTaskManager from a single
+# thread using non-blocking sockets and select.poll, instead of one thread
+# with blocking I/O per client. The user-defined hooks are called exactly as
+# they are by the threaded engine.
+
+READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+WRITE_EVENTS = READ_EVENTS | select.POLLOUT
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+# State of one framed connection served by the event loop.
+class LoopConnection:
+    def __init__(self, sock, session):
+        self.sock = sock
+        self.session = session
+        self.fd = sock.fileno()
+        self.closed = False
+        self.reader = FrameReader()
+        self.send_queue = collections.deque()
+
+    def queue_frame(self, msg_type, job_id, payload=b"", meta=None):
+        for buf in frame_buffers(msg_type, job_id, payload, meta):
+            self.send_queue.append(byte_view(buf))
+
+    # Writes as much of the send queue as the socket will take. Returns True
+    # once the queue is empty.
+    def flush(self):
+        while self.send_queue:
+            buf = self.send_queue[0]
+            try:
+                sent = self.sock.send(buf)
+            except socket.error as err:
+                if err.args[0] in WOULD_BLOCK:
+                    return False
+                raise
+            if sent < len(buf):
+                self.send_queue[0] = buf[sent:]
+                return False
+            self.send_queue.popleft()
+        return True
+
+
+class EventLoopEngine:
+    def __init__(self, manager):
+        self.manager = manager
+        self.poller = select.poll()
+        self.listeners = {}
+        self.connections = {}
+        # Handshakes are blocking, so they run on short-lived threads which
+        # hand finished framed connections back to the loop through this
+        # queue, waking the loop up with a byte on the wakeup pair. The
+        # manager also wakes the loop whenever new tasks may be available.
+        self.adopted = collections.deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(0)
+
+    # Runs the loop until the manager stops.
+    def run(self, servers):
+        manager = self.manager
+        for server in servers:
+            server.listen(manager.connection_backlog_max)
+            server.setblocking(0)
+            self.listeners[server.fileno()] = server
+            self.poller.register(server, select.POLLIN)
+        self.poller.register(self.wakeup_recv, select.POLLIN)
+        manager.task_listeners.append(self.wake)
+
+        while not manager.stop:
+            self.dispatch()
+            try:
+                events = self.poller.poll(manager.server_timeout * 1000)
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd in self.listeners:
+                    self.accept(self.listeners[fd])
+                elif fd == self.wakeup_recv.fileno():
+                    self.on_wakeup()
+                elif fd in self.connections:
+                    self.service(self.connections[fd], event)
+
+        self.shutdown()
+
+    # Accepts every pending connection, starting a handshake thread for each.
+    def accept(self, server):
+        while True:
+            try:
+                sock, port = server.accept()
+            except socket.error as err:
+                if err.args[0] in WOULD_BLOCK:
+                    return
+                self.manager.request_stop()
+                return
+            sock.setblocking(1)
+            thread = threading.Thread(target=self.handshake, args=(sock,))
+            thread.start()
+            self.manager.log("CONNECTED TO: %s" % str(port))
+
+    # Runs the blocking client setup. Framed connections are handed to the
+    # loop, legacy ones keep a thread of their own since their protocol
+    # needs an acknowledgement for every message.
+    def handshake(self, sock):
+        manager = self.manager
+        manager.change_connected_count(1)
+        peer_name = str(sock.getpeername())
+        try:
+            connection = manager.setup_client(sock)
+        except socket.error as err:
+            manager.log("[ERROR] {}\n".format(err))
+            sock.close()
+            manager.change_connected_count(-1)
+            return
+
+        if connection.protocol != "framed":
+            manager.serve_connection(connection, peer_name)
+            return
+        sock.setblocking(0)
+        self.adopted.append(LoopConnection(sock, manager.open_session(connection, peer_name)))
+        self.wake()
+
+    # Interrupts the poll from another thread.
+    def wake(self):
+        try:
+            self.wakeup_send.send(b"x")
+        except socket.error:
+            pass
+
+    # Drains the wakeup pair and adopts any connections that finished their
+    # handshake. Dispatching happens on every pass of the loop.
+    def on_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self.adopted:
+            conn = self.adopted.popleft()
+            self.connections[conn.fd] = conn
+            self.poller.register(conn.fd, READ_EVENTS)
+
+    # Fills the window of every connection with jobs.
+    def dispatch(self):
+        manager = self.manager
+        for conn in list(self.connections.values()):
+            try:
+                while conn.session.has_room():
+                    job = manager.next_job(conn.session)
+                    if job is None:
+                        break
+                    start_time = time.time()
+                    for frame in manager.pending_frames(conn.session):
+                        conn.queue_frame(*frame)
+                    conn.queue_frame(MSG_JOB, *job)
+                    manager.trace("send", start_time, {"job": job[0]})
+            except Exception as err:
+                self.drop(conn, err)
+                continue
+            self.write(conn)
+
+    def write(self, conn):
+        try:
+            flushed = conn.flush()
+        except Exception as err:
+            self.drop(conn, err)
+            return
+        self.poller.modify(conn.fd, READ_EVENTS if flushed else WRITE_EVENTS)
+
+    def service(self, conn, event):
+        if event & select.POLLOUT:
+            self.write(conn)
+        if conn.closed or not event & READ_EVENTS:
+            return
+        try:
+            for frame in conn.reader.read_available(conn.sock):
+                self.manager.receive_message(conn.session, *frame)
+        except Exception as err:
+            self.drop(conn, err)
+
+    # Removes a connection that failed, requeueing its outstanding jobs.
+    def drop(self, conn, err):
+        self.manager.drop_session(conn.session, err)
+        self.remove(conn)
+
+    def remove(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        del self.connections[conn.fd]
+        self.poller.unregister(conn.fd)
+        self.manager.close_session(conn.session)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        self.manager.change_connected_count(-1)
+
+    # Tells every client to close and releases the listening sockets.
+    def shutdown(self):
+        self.manager.task_listeners.remove(self.wake)
+        for conn in list(self.connections.values()):
+            # A partially written frame can't be followed by anything else.
+            if not conn.send_queue:
+                try:
+                    conn.sock.setblocking(1)
+                    conn.sock.sendall(pack_header(MSG_CLOSE, 0, 0))
+                except socket.error:
+                    pass
+            self.remove(conn)
+        for server in self.listeners.values():
+            try:
+                server.close()
+            except socket.error:
+                pass
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        self.manager.request_stop()
+        self.manager.log("EXITING MAIN")
@@ -0,0 +1,238 @@
+import collections
+import hashlib
+import itertools
+import marshal
+import threading
+import time
+
+try:
+    from concurrent.futures import Future, TimeoutError
+except ImportError:
+    Future = None
+
+from .distribuPy import DistributedTaskManager
+
+
+# Distributed Executor #
+
+# A concurrent.futures style front end to DistributedTaskManager. Functions
+# are sent to the clients as marshalled code objects, so they must be plain
+# functions without closures, the clients must run the same Python version
+# as the coordinator, and anything a function needs has to be imported inside
+# its body. Arguments and results travel pickled.
+
+# Client code run by every client of an executor. Each task holds a function
+# and a chunk of argument tuples, its response is ("ok", results) or
+# ("error", exception).
+CLIENT_LABELS = '["task"]\n'
+CLIENT_CODE = '''
+def task(self, tasks):
+    import marshal
+    import pickle
+    import types
+    functions = self.__dict__.setdefault("executor_functions", {})
+    responses = []
+    for digest, code, defaults, chunk in tasks:
+        function = functions.get(digest)
+        if function is None:
+            function = types.FunctionType(marshal.loads(code), {"__builtins__": __builtins__}, None, defaults)
+            functions[digest] = function
+        try:
+            responses.append(("ok", [function(*args) for args in chunk]))
+        except Exception as err:
+            try:
+                pickle.dumps(err)
+            except Exception:
+                err = RuntimeError(repr(err))
+            responses.append(("error", err))
+    return responses
+'''
+
+
+if Future is None:
+    class TimeoutError(Exception):
+        pass
+
+    # Stand-in for concurrent.futures.Future where that isn't available.
+    class Future:
+        def __init__(self):
+            self.condition = threading.Condition()
+            self.finished = False
+            self.value = None
+            self.error = None
+            self.callbacks = []
+
+        def done(self):
+            return self.finished
+
+        def cancelled(self):
+            return False
+
+        def cancel(self):
+            return False
+
+        def running(self):
+            return not self.finished
+
+        def result(self, timeout=None):
+            self.wait(timeout)
+            if self.error is not None:
+                raise self.error
+            return self.value
+
+        def exception(self, timeout=None):
+            self.wait(timeout)
+            return self.error
+
+        def add_done_callback(self, callback):
+            with self.condition:
+                if not self.finished:
+                    self.callbacks.append(callback)
+                    return
+            callback(self)
+
+        def set_result(self, value):
+            self.finish(value, None)
+
+        def set_exception(self, error):
+            self.finish(None, error)
+
+        def finish(self, value, error):
+            with self.condition:
+                self.value = value
+                self.error = error
+                self.finished = True
+                self.condition.notify_all()
+                callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+        def wait(self, timeout):
+            with self.condition:
+                if timeout is None:
+                    while not self.finished:
+                        self.condition.wait()
+                elif not self.finished:
+                    self.condition.wait(timeout)
+            if not self.finished:
+                raise TimeoutError()
+
+
+class DistributedExecutor(DistributedTaskManager):
+    def __init__(self, tasks_per_job=1):
+        # Tasks submitted but not handed out yet, and the future of every
+        # task that hasn't been answered, by task id.
+        self.pending = collections.deque()
+        self.futures = {}
+        self.futures_lock = threading.Lock()
+        self.task_ids = itertools.count()
+        self.shutting_down = False
+
+        DistributedTaskManager.__init__(self, tasks_per_job)
+        self.codecs = ["pickle"]
+
+    # Schedules fn(*args) on a client and returns a future for its result.
+    def submit(self, fn, *args):
+        future, = self.submit_chunks(fn, [[args]], True)
+        return future
+
+    # Like the builtin map but the calls run on the clients, chunksize
+    # argument tuples per task. Results are yielded in order as they arrive.
+    def map(self, fn, *iterables, **kwargs):
+        timeout = kwargs.get("timeout")
+        chunksize = kwargs.get("chunksize", 1)
+        calls = list(zip(*iterables))
+        chunks = [calls[start:start + chunksize] for start in range(0, len(calls), chunksize)]
+        futures = self.submit_chunks(fn, chunks, False)
+        deadline = None if timeout is None else time.time() + timeout
+
+        def results():
+            for future in futures:
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                for value in future.result(remaining):
+                    yield value
+        return results()
+
+    # Waits for every submitted call to finish, then stops the manager.
+    def shutdown(self, wait=True):
+        self.shutting_down = True
+        self.notify_state_changed()
+        if wait:
+            self.spin(0.1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
+
+    # Queues one task per chunk of argument tuples and returns their futures,
+    # which resolve to the list of results of their chunk or, if single, to
+    # the result of its only call.
+    def submit_chunks(self, fn, chunks, single):
+        if self.shutting_down:
+            raise RuntimeError("cannot schedule new calls after shutdown")
+        function = self.describe_function(fn)
+        futures = []
+        with self.task_gen_lock:
+            for chunk in chunks:
+                future = Future()
+                task_id = next(self.task_ids)
+                with self.futures_lock:
+                    self.futures[task_id] = (future, single)
+                self.pending.append((task_id, function + (chunk,)))
+                futures.append(future)
+        self.notify_tasks_available()
+        return futures
+
+    # Returns the marshalled description of fn sent along with its tasks.
+    def describe_function(self, fn):
+        code = getattr(fn, "__code__", None)
+        if code is None or getattr(fn, "__closure__", None):
+            raise ValueError("Only plain functions without closures can be run remotely")
+        data = marshal.dumps(code)
+        return hashlib.sha1(data).hexdigest(), data, fn.__defaults__
+
+    def read_in_client_code(self):
+        self.client_labels = CLIENT_LABELS
+        self.client_code = CLIENT_CODE
+
+    # There is a single repetition that lasts until shutdown.
+    def is_repetition_finished(self):
+        with self.futures_lock:
+            return self.shutting_down and not self.futures
+
+    def is_simulation_finished(self):
+        return self.repetitions_finished >= 1
+
+    # Hands out submitted tasks, yielding None while there are none.
+    def task_generator(self):
+        while True:
+            if self.pending:
+                yield self.pending.popleft()
+            else:
+                yield None
+
+    def reset_responses(self):
+        pass
+
+    def set_next_repetition(self):
+        pass
+
+    def record_response(self, task, response):
+        self.job_buffer.append((task, response))
+
+    # Resolves the future of a task. Callbacks run on the jobIntegration
+    # threads.
+    def record_job(self, job):
+        task, response = job
+        with self.futures_lock:
+            future, single = self.futures.pop(task[0])
+        status, value = response
+        if status == "error":
+            future.set_exception(value)
+        elif single:
+            future.set_result(value[0])
+        else:
+            future.set_result(value)
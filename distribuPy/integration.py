@@ -0,0 +1,89 @@
+import multiprocessing
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from .workerpool import fork_context
+
+
+# Sharded Integration #
+
+# Records jobs on forked processes instead of the jobIntegration threads so
+# CPU-heavy record_job functions aren't serialized by the GIL. Every shard
+# process has its own copy of the manager and records the jobs whose
+# partition_key maps to it into that copy. Once a repetition is integrated
+# each shard hands over what it recorded with collect_shard and the
+# coordinator merges the pieces with combine_shards.
+
+def run_shard(manager, index, inbox, outbox):
+    while True:
+        message = inbox.get()
+        if message is None:
+            return
+        kind, value = message
+        if kind == "jobs":
+            for job in value:
+                try:
+                    manager.record_job(job)
+                except Exception:
+                    traceback.print_exc()
+        else:
+            try:
+                outbox.put((index, manager.collect_shard(*value)))
+            except Exception:
+                traceback.print_exc()
+                outbox.put((index, None))
+
+
+class ShardedIntegrator:
+    # Forks the shard processes, one per core if shards is None. Should be
+    # called before the manager starts any threads.
+    def __init__(self, manager, shards=None):
+        self.manager = manager
+        self.count = shards or multiprocessing.cpu_count()
+        context = fork_context()
+        self.inboxes = [context.Queue() for i in range(self.count)]
+        self.outbox = context.Queue()
+        self.processes = []
+        for index, inbox in enumerate(self.inboxes):
+            process = context.Process(target=run_shard, args=(manager, index, inbox, self.outbox))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    # Hands jobs to the shards their partition keys map to. Jobs reach each
+    # shard in the order they were submitted.
+    def submit(self, jobs):
+        batches = {}
+        for job in jobs:
+            shard = hash(self.manager.partition_key(job)) % self.count
+            batches.setdefault(shard, []).append(job)
+        for shard, batch in batches.items():
+            self.inboxes[shard].put(("jobs", batch))
+
+    # Waits for every shard to record the jobs submitted so far and returns
+    # what each of them collected, in shard order. args are passed on to
+    # collect_shard. A shard that died contributes None.
+    def collect(self, args=()):
+        for inbox in self.inboxes:
+            inbox.put(("collect", tuple(args)))
+        partials = [None] * self.count
+        waiting = set(range(self.count))
+        while waiting:
+            try:
+                index, partial = self.outbox.get(timeout=1.0)
+            except queue.Empty:
+                waiting = set(index for index in waiting if self.processes[index].is_alive())
+                continue
+            partials[index] = partial
+            waiting.discard(index)
+        return partials
+
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(1.0)
@@ -0,0 +1,130 @@
+import collections
+import threading
+import time
+
+
+# Job Buffer #
+
+# Bounded multi-producer/multi-consumer queue holding the jobs produced by
+# record_response until the jobIntegration threads record them. Appending
+# never blocks, since user code may append while holding its own locks.
+# Instead the manager stops dispatching new jobs while the buffer is full.
+class JobBuffer:
+    def __init__(self, max_size=10000, on_room=None):
+        self.jobs = collections.deque()
+        # Zero means unbounded.
+        self.max_size = max_size
+        # Called (outside the lock) when a full buffer gets room again.
+        self.on_room = on_room
+        # Jobs popped by integrators that haven't been recorded yet.
+        self.in_progress = 0
+        # Largest depth seen since the last call to reset_high_water.
+        self.high_water = 0
+        self.closed = False
+        # Whether appended jobs are stamped with the time, see pop_batch.
+        # Must not change while the buffer holds jobs.
+        self.timed = False
+        # Numbers of jobs ever appended and ever popped, and the number of the
+        # first job of the batch each integrator thread is recording. They
+        # tell whether every job appended before some point is recorded.
+        self.appended = 0
+        self.popped = 0
+        self.batches = {}
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.drained = threading.Condition(self.lock)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def full(self):
+        return self.max_size > 0 and len(self.jobs) >= self.max_size
+
+    def append(self, job):
+        with self.lock:
+            self.jobs.append((time.time() if self.timed else None, job))
+            self.appended += 1
+            self.high_water = max(self.high_water, len(self.jobs))
+            self.not_empty.notify()
+
+    def extend(self, jobs):
+        with self.lock:
+            size = len(self.jobs)
+            enqueued_at = time.time() if self.timed else None
+            self.jobs.extend((enqueued_at, job) for job in jobs)
+            self.appended += len(self.jobs) - size
+            self.high_water = max(self.high_water, len(self.jobs))
+            self.not_empty.notify_all()
+
+    # Removes and returns the newest job, like list.pop.
+    def pop(self):
+        was_full = self.full()
+        with self.lock:
+            enqueued_at, job = self.jobs.pop()
+            self.appended -= 1
+        self.room_made(was_full)
+        return job
+
+    # Blocks until there are jobs, then removes and returns up to count of
+    # the oldest ones. Each must be acknowledged with task_done once it has
+    # been recorded. Returns an empty list once the buffer is closed. With
+    # timed, returns (enqueued_at, job) pairs instead, enqueued_at being None
+    # for jobs appended while the buffer wasn't timed.
+    def pop_batch(self, count, timed=False):
+        with self.lock:
+            while not self.closed and not self.jobs:
+                self.not_empty.wait()
+            was_full = self.full()
+            jobs = []
+            while self.jobs and len(jobs) < count:
+                jobs.append(self.jobs.popleft())
+            self.in_progress += len(jobs)
+            self.batches[threading.current_thread()] = self.popped
+            self.popped += len(jobs)
+        self.room_made(was_full)
+        if timed:
+            return jobs
+        return [job for enqueued_at, job in jobs]
+
+    def task_done(self, count):
+        with self.lock:
+            self.in_progress -= count
+            self.batches.pop(threading.current_thread(), None)
+            self.drained.notify_all()
+
+    # Blocks until every job has been popped and recorded, or the buffer is
+    # closed.
+    def wait_drained(self):
+        with self.lock:
+            while not self.closed and (self.jobs or self.in_progress):
+                self.drained.wait()
+
+    # Returns a mark for wait_integrated covering every job appended so far.
+    def mark(self):
+        with self.lock:
+            return self.appended
+
+    # Blocks until every job appended before mark was taken has been
+    # recorded, or the buffer is closed, even while newer jobs keep coming.
+    def wait_integrated(self, mark):
+        with self.lock:
+            # Jobs taken back with pop are never recorded.
+            mark = min(mark, self.appended)
+            while not self.closed and min([self.popped] + list(self.batches.values())) < mark:
+                self.drained.wait()
+
+    def reset_high_water(self):
+        with self.lock:
+            self.high_water = len(self.jobs)
+
+    # Wakes everything waiting on the buffer for good.
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.drained.notify_all()
+
+    def room_made(self, was_full):
+        if was_full and not self.full() and self.on_room is not None:
+            self.on_room()
@@ -0,0 +1,224 @@
+import json
+import threading
+import time
+
+try:
+    import BaseHTTPServer as http_server
+except ImportError:
+    import http.server as http_server
+
+from .protocol import is_ndarray
+
+
+# Metrics #
+
+# Counts what goes through a manager so a slow run can be told apart as
+# network, worker or integration bound. Every job sent and answered updates
+# a few counters and histograms under one lock. snapshot returns everything
+# as a dict, and a MetricsServer serves it over HTTP in the Prometheus text
+# format.
+
+# Upper bounds of the histogram buckets in seconds.
+SECOND_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+
+# Number of bytes in a job or result payload.
+def payload_size(payload):
+    if is_ndarray(payload):
+        return payload.nbytes
+    if isinstance(payload, list):
+        return sum(payload_size(part) for part in payload)
+    try:
+        return len(payload)
+    except TypeError:
+        return 0
+
+
+class Histogram:
+    def __init__(self, buckets=SECOND_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    # Returns the cumulative count of every bucket, as Prometheus has them.
+    def snapshot(self):
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+# Traffic to and from one client.
+class WorkerStats:
+    def __init__(self):
+        self.first_seen = time.time()
+        self.jobs = 0
+        self.tasks = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.workers = {}
+        self.round_trip = Histogram()
+        self.compute = Histogram()
+        self.integration_busy = 0.0
+        self.jobs_integrated = 0
+        self.lock = threading.Lock()
+
+    def worker(self, name):
+        if name not in self.workers:
+            self.workers[name] = WorkerStats()
+        return self.workers[name]
+
+    def job_sent(self, worker, size):
+        with self.lock:
+            self.worker(worker).bytes_sent += size
+
+    # round_trip and compute are in seconds, None when unknown.
+    def job_answered(self, worker, tasks, size, round_trip, compute):
+        with self.lock:
+            stats = self.worker(worker)
+            stats.jobs += 1
+            stats.tasks += tasks
+            stats.bytes_received += size
+            if round_trip is not None:
+                self.round_trip.observe(round_trip)
+            if compute is not None:
+                self.compute.observe(compute)
+
+    def integrated(self, jobs, seconds):
+        with self.lock:
+            self.jobs_integrated += jobs
+            self.integration_busy += seconds
+
+    # Returns the counters, with per worker rates averaged over the time
+    # since the worker was first seen. gauges holds the current queue depths
+    # and such, added as they are.
+    def snapshot(self, gauges):
+        now = time.time()
+        with self.lock:
+            workers = {}
+            for name, stats in self.workers.items():
+                elapsed = max(now - stats.first_seen, 1e-9)
+                workers[name] = {"jobs": stats.jobs, "tasks": stats.tasks,
+                                 "bytes_sent": stats.bytes_sent, "bytes_received": stats.bytes_received,
+                                 "tasks_per_second": stats.tasks / elapsed,
+                                 "bytes_per_second": (stats.bytes_sent + stats.bytes_received) / elapsed}
+            snapshot = {"time": now, "uptime": now - self.started, "workers": workers,
+                        "round_trip_seconds": self.round_trip.snapshot(),
+                        "compute_seconds": self.compute.snapshot(),
+                        "integration_busy_seconds": self.integration_busy,
+                        "jobs_integrated": self.jobs_integrated}
+        snapshot.update(gauges)
+        return snapshot
+
+
+# Prometheus Text Format #
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+# Renders a snapshot in the Prometheus text exposition format.
+def prometheus_text(snapshot):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP distribupy_{} {}".format(name, help_text))
+        lines.append("# TYPE distribupy_{} {}".format(name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(key, label_value(val)) for key, val in labels)
+            lines.append("distribupy_{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+    workers = sorted(snapshot["workers"].items())
+    for key, kind, help_text in (("tasks", "counter", "Tasks answered by a worker."),
+                                 ("jobs", "counter", "Jobs answered by a worker."),
+                                 ("bytes_sent", "counter", "Job payload bytes sent to a worker."),
+                                 ("bytes_received", "counter", "Result payload bytes received from a worker.")):
+        metric(key + "_total", kind, help_text, [((("worker", name),), stats[key]) for name, stats in workers])
+    metric("tasks_per_second", "gauge", "Tasks answered per second since the worker connected.",
+           [((("worker", name),), stats["tasks_per_second"]) for name, stats in workers])
+    metric("bytes_per_second", "gauge", "Payload bytes per second since the worker connected.",
+           [((("worker", name),), stats["bytes_per_second"]) for name, stats in workers])
+
+    for key, help_text in (("round_trip_seconds", "Time from sending a job to receiving its result."),
+                           ("compute_seconds", "Time clients spent computing a job.")):
+        histogram = snapshot[key]
+        lines.append("# HELP distribupy_{} {}".format(key, help_text))
+        lines.append("# TYPE distribupy_{} histogram".format(key))
+        for bound, count in histogram["buckets"]:
+            lines.append('distribupy_{}_bucket{{le="{}"}} {}'.format(key, format_bound(bound), count))
+        lines.append("distribupy_{}_sum {}".format(key, histogram["sum"]))
+        lines.append("distribupy_{}_count {}".format(key, histogram["count"]))
+
+    metric("integration_busy_seconds_total", "counter", "Time spent recording jobs.",
+           [((), snapshot["integration_busy_seconds"])])
+    metric("jobs_integrated_total", "counter", "Jobs recorded.", [((), snapshot["jobs_integrated"])])
+    for key, help_text in (("connected_workers", "Connected clients."),
+                           ("job_buffer_depth", "Jobs waiting to be recorded."),
+                           ("drop_buffer_depth", "Dropped tasks waiting to be handed out again."),
+                           ("outstanding_jobs", "Jobs sent and not answered yet.")):
+        metric(key, "gauge", help_text, [((), snapshot[key])])
+    return "\n".join(lines) + "\n"
+
+
+# Metrics Endpoint #
+
+# Serves the metrics of a manager at /metrics in the Prometheus text format
+# and at /metrics.json as JSON, from a thread of its own.
+class MetricsServer:
+    def __init__(self, manager, host="127.0.0.1", port=9100):
+        class Handler(MetricsHandler):
+            pass
+        Handler.manager = manager
+        self.server = http_server.HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsHandler(http_server.BaseHTTPRequestHandler):
+    manager = None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = prometheus_text(self.manager.metrics_snapshot())
+            content_type = "text/plain; version=0.0.4"
+        elif path == "/metrics.json":
+            body = json.dumps(self.manager.metrics_snapshot())
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests aren't logged to stderr.
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .serializers import PICKLE_PROTOCOL
+
+
+# Object Store #
+
+# Large read-only data shared by many tasks is put in the object store once
+# and tasks carry a handle to it instead of a copy. Before a job that refers
+# to an object is sent to a client, the object is sent ahead of it unless
+# that client already has it, and the client keeps it until it disconnects
+# or the object is released. Client code looks objects up with
+# self.get_object(handle).
+
+# Handles are strings so they survive every structured codec. A codec that
+# doesn't keep the class hands the client code a plain string, which
+# get_object accepts just the same.
+class ObjectHandle(str):
+    pass
+
+
+# Yields the handles found in a task payload, looking inside lists, tuples
+# and dicts.
+def find_handles(payload):
+    if isinstance(payload, ObjectHandle):
+        yield payload
+    elif isinstance(payload, (list, tuple)):
+        for item in payload:
+            for handle in find_handles(item):
+                yield handle
+    elif isinstance(payload, dict):
+        for item in payload.items():
+            for handle in find_handles(item):
+                yield handle
+
+
+# The coordinator's objects, kept pickled by handle.
+class ObjectStore:
+    def __init__(self):
+        self.objects = {}
+        # Number of puts not released yet, by handle.
+        self.references = {}
+        self.lock = threading.Lock()
+
+    # Adds an object and returns its handle. Equal objects share a handle,
+    # which stays valid until it has been released once for every put.
+    def put(self, value):
+        data = pickle.dumps(value, PICKLE_PROTOCOL)
+        handle = ObjectHandle(hashlib.sha1(data).hexdigest())
+        with self.lock:
+            self.objects[handle] = data
+            self.references[handle] = self.references.get(handle, 0) + 1
+        return handle
+
+    def data(self, handle):
+        with self.lock:
+            if handle not in self.objects:
+                raise KeyError("Object {} has been released".format(handle))
+            return self.objects[handle]
+
+    # Drops one reference to an object. Returns True if that was the last
+    # one and the object is gone.
+    def release(self, handle):
+        with self.lock:
+            if handle not in self.references:
+                return False
+            self.references[handle] -= 1
+            if self.references[handle] > 0:
+                return False
+            del self.references[handle]
+            del self.objects[handle]
+            return True
+
+    # Returns the handles that the task payloads refer to.
+    def referenced(self, payloads):
+        if not self.objects:
+            return set()
+        return set(handle for payload in payloads for handle in find_handles(payload))
+
+
+# The objects a client has received. With worker processes the objects are
+# written to a directory in shared memory, /dev/shm where there is one, so
+# every worker reads them from there instead of getting a copy of its own.
+class ObjectCache:
+    def __init__(self):
+        self.values = {}
+        self.pickled = {}
+        self.shared_dir = None
+
+    # Makes received objects visible to processes forked from now on.
+    def share(self):
+        if self.shared_dir is None:
+            base = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            self.shared_dir = tempfile.mkdtemp(prefix="distribuPy-objects-", dir=base)
+
+    def add(self, handle, data):
+        handle = str(handle)
+        if self.shared_dir is None:
+            self.pickled[handle] = data
+            return
+        path = os.path.join(self.shared_dir, handle)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+
+    def discard(self, handle):
+        handle = str(handle)
+        self.values.pop(handle, None)
+        self.pickled.pop(handle, None)
+        if self.shared_dir is not None:
+            try:
+                os.remove(os.path.join(self.shared_dir, handle))
+            except OSError:
+                pass
+
+    # Returns the object of a handle, unpickling it on first use.
+    def get(self, handle):
+        handle = str(handle)
+        if handle not in self.values:
+            data = self.pickled.pop(handle, None)
+            if data is None:
+                if self.shared_dir is None:
+                    raise KeyError("Object {} was not received".format(handle))
+                with open(os.path.join(self.shared_dir, handle), "rb") as f:
+                    data = f.read()
+            self.values[handle] = pickle.loads(data)
+        return self.values[handle]
+
+    def close(self):
+        if self.shared_dir is not None:
+            shutil.rmtree(self.shared_dir, True)
+            self.shared_dir = None
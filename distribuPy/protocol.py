@@ -0,0 +1,412 @@
+import errno
+import json
+import socket
+import struct
+import threading
+
+from .serializers import LEGACY_CODEC
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Wire Protocol #
+
+# Every framed message starts with a fixed binary header holding the message
+# type, a flags byte, the id of the job the message belongs to and the length
+# of the payload that follows. There is no per-message acknowledgement.
+FRAME_HEADER = struct.Struct("!BBIQ")
+
+# Message types.
+MSG_HELLO = 1
+MSG_SETUP = 2
+MSG_JOB = 3
+MSG_RESULT = 4
+MSG_CLOSE = 5
+# Sent by clients every heartbeat_interval seconds so the coordinator can tell
+# a busy client from a hung one.
+MSG_HEARTBEAT = 6
+# Sent by the coordinator ahead of the first job that refers to a shared
+# object, with the handle in the metadata and the pickled object as payload.
+# With "release" in the metadata it tells the client to drop the object.
+MSG_OBJECT = 7
+# Sent by a coordinator serving several workloads ahead of the first job of
+# a workload, with the workload's name and code hash in the metadata and
+# its client code as payload unless the client has it cached.
+MSG_CODE = 8
+
+# Payload flags. An ndarray payload starts with its dtype and shape and is
+# followed by the raw array memory. A parts payload starts with a table of
+# part lengths and is followed by the parts themselves. A payload with
+# metadata starts with a small JSON dict ahead of everything else.
+FLAG_NDARRAY = 0x01
+FLAG_PARTS = 0x02
+FLAG_META = 0x04
+
+# Array memory and parts start at multiples of this many bytes within a
+# payload so the receiver can view them in place with correct alignment.
+ALIGNMENT = 16
+PADDING = b"\0" * ALIGNMENT
+COUNT = struct.Struct("!I")
+PART_LENGTH = struct.Struct("!Q")
+
+# Sent by a framed client in place of the legacy "CONFIRMED" reply to the
+# size of the task instructions. It is exactly small_message_size bytes long.
+FRAMED_MAGIC = b"DPYFRAMED1"
+
+# Payloads smaller than this are joined with their header before sending so
+# that small frames go out in a single segment.
+COALESCE_LIMIT = 64 * 1024
+
+
+def is_ndarray(obj):
+    return np is not None and isinstance(obj, np.ndarray)
+
+
+# Returns a flat byte view of a buffer without copying it. Arrays must be
+# contiguous.
+def byte_view(buf):
+    if is_ndarray(buf):
+        if not buf.flags.c_contiguous:
+            raise ValueError("Only contiguous arrays can be sent or received in place")
+        return memoryview(buf.reshape(-1).view(np.uint8))
+    view = memoryview(buf)
+    if view.format != "B" and hasattr(view, "cast"):
+        view = view.cast("B")
+    return view
+
+
+def padding(length):
+    return PADDING[:-length % ALIGNMENT]
+
+
+# A part of a received parts payload, left in the receive buffer.
+class Segment:
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def tobytes(self):
+        return bytes(self.buf[self.offset:self.offset + self.length])
+
+    def view(self):
+        return memoryview(self.buf)[self.offset:self.offset + self.length]
+
+    # Views the segment as an array without copying it.
+    def array(self, dtype, shape):
+        dtype = np.dtype(dtype)
+        count = self.length // dtype.itemsize
+        return np.frombuffer(self.buf, dtype, count, self.offset).reshape(shape)
+
+
+# Returns a length prefixed JSON block padded to the alignment.
+def json_block(info):
+    data = encode_handshake(info)
+    data += b" " * (-(COUNT.size + len(data)) % ALIGNMENT)
+    return COUNT.pack(len(data)) + data
+
+
+# Reads a JSON block at offset, returning it and the offset following it.
+def read_json_block(buf, offset):
+    length, = COUNT.unpack_from(buf, offset)
+    start = offset + COUNT.size
+    return decode_handshake(bytes(buf[start:start + length])), start + length
+
+
+# Returns the frame flags and the buffers that make up a payload. Payloads
+# can be bytes-like objects, NumPy arrays or a list of those sent as parts,
+# the buffers reference the original memory. meta is an optional dict sent
+# along with the payload.
+def payload_buffers(payload, meta=None):
+    flags, buffers = 0, [payload]
+    if is_ndarray(payload):
+        info = {"dtype": payload.dtype.str, "shape": list(payload.shape)}
+        flags, buffers = FLAG_NDARRAY, [json_block(info), byte_view(payload)]
+    elif isinstance(payload, list):
+        views = [byte_view(part) for part in payload]
+        table = COUNT.pack(len(views)) + b"".join(PART_LENGTH.pack(len(view)) for view in views)
+        flags, buffers = FLAG_PARTS, [table + padding(len(table))]
+        for view in views:
+            buffers.append(view)
+            if len(view) % ALIGNMENT:
+                buffers.append(padding(len(view)))
+    if meta:
+        flags |= FLAG_META
+        buffers.insert(0, json_block(meta))
+    return flags, buffers
+
+
+# Rebuilds a payload received into buf, viewing arrays and parts in place.
+# Returns the payload and its metadata, or None if there was none.
+def decode_payload(flags, buf):
+    meta, offset = None, 0
+    if flags & FLAG_META:
+        meta, offset = read_json_block(buf, offset)
+    if flags & FLAG_NDARRAY:
+        info, offset = read_json_block(buf, offset)
+        return Segment(buf, offset, len(buf) - offset).array(info["dtype"], info["shape"]), meta
+    if flags & FLAG_PARTS:
+        count, = COUNT.unpack_from(buf, offset)
+        table = offset + COUNT.size
+        offset = table + count * PART_LENGTH.size
+        offset += -offset % ALIGNMENT
+        parts = []
+        for i in range(count):
+            length, = PART_LENGTH.unpack_from(buf, table + i * PART_LENGTH.size)
+            parts.append(Segment(buf, offset, length))
+            offset += length + (-length % ALIGNMENT)
+        return parts, meta
+    return memoryview(buf)[offset:].tobytes(), meta
+
+
+# Receives exactly len(view) bytes from sock into view.
+def receive_into(sock, view):
+    size = len(view)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise socket.error("Connection closed by peer")
+        received += count
+
+
+# Receives exactly size bytes from sock into a preallocated buffer.
+def receive_exactly(sock, size):
+    buf = bytearray(size)
+    receive_into(sock, memoryview(buf))
+    return buf
+
+
+# Sends the given buffers back to back, with a single scatter-gather
+# sendmsg where the platform has it.
+def send_buffers(sock, buffers):
+    if not hasattr(sock, "sendmsg"):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [byte_view(buf) for buf in buffers]
+    while views:
+        sent = sock.sendmsg(views[:512])
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+        while views and len(views[0]) == 0:
+            views.pop(0)
+
+
+# Packs a frame header for a payload of the given length.
+def pack_header(msg_type, job_id, length, flags=0):
+    return FRAME_HEADER.pack(msg_type, flags, job_id, length)
+
+
+# Returns the buffers making up a whole frame.
+def frame_buffers(msg_type, job_id, payload=b"", meta=None):
+    flags, buffers = payload_buffers(payload, meta)
+    length = sum(len(buf) if isinstance(buf, bytes) else len(byte_view(buf)) for buf in buffers)
+    header = pack_header(msg_type, job_id, length, flags)
+    if length < COALESCE_LIMIT and all(isinstance(buf, bytes) for buf in buffers):
+        return [header + b"".join(buffers)]
+    return [header] + buffers
+
+
+# Sends a single framed message.
+def send_frame(sock, msg_type, job_id, payload=b"", meta=None):
+    send_buffers(sock, frame_buffers(msg_type, job_id, payload, meta))
+
+
+# Receives a single framed message, returning (msg_type, job_id, payload,
+# meta).
+def receive_frame(sock):
+    header = receive_exactly(sock, FRAME_HEADER.size)
+    msg_type, flags, job_id, length = FRAME_HEADER.unpack_from(header)
+    payload, meta = decode_payload(flags, receive_exactly(sock, length))
+    return msg_type, job_id, payload, meta
+
+
+# Incrementally assembles frames from a non-blocking socket. Each frame is
+# read straight into a buffer preallocated from its header.
+class FrameReader:
+    def __init__(self):
+        self.header = bytearray(FRAME_HEADER.size)
+        self.payload = None
+        self.msg_type = None
+        self.flags = 0
+        self.job_id = None
+        self.filled = 0
+
+    # Reads whatever is available from sock and returns the list of frames
+    # completed by it. Raises socket.error when the peer has closed.
+    def read_available(self, sock):
+        frames = []
+        while True:
+            target = self.header if self.payload is None else self.payload
+            try:
+                count = sock.recv_into(memoryview(target)[self.filled:], len(target) - self.filled)
+            except socket.error as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return frames
+                raise
+            if count == 0:
+                raise socket.error("Connection closed by peer")
+            self.filled += count
+            if self.filled < len(target):
+                continue
+            self.filled = 0
+            if self.payload is None:
+                self.msg_type, self.flags, self.job_id, length = FRAME_HEADER.unpack_from(self.header)
+                self.payload = bytearray(length)
+                if length != 0:
+                    continue
+            payload, meta = decode_payload(self.flags, self.payload)
+            frames.append((self.msg_type, self.job_id, payload, meta))
+            self.payload = None
+
+
+def encode_handshake(info):
+    return json.dumps(info).encode("utf-8")
+
+
+def decode_handshake(payload):
+    return json.loads(payload)
+
+
+# Connections #
+
+# Both connection types expose the same send/receive interface so the
+# manager and client do not need to care which protocol was negotiated.
+
+class FramedConnection:
+    protocol = "framed"
+    # Seconds between heartbeats from the client, zero if it doesn't send
+    # them. Set during negotiation.
+    heartbeat_interval = 0
+    # Number of tasks the client runs at once, set during negotiation.
+    parallelism = 1
+    # Number of jobs the client decodes ahead, set during negotiation.
+    prefetch = 0
+    # Whether the client combines responses, set during negotiation.
+    combine = False
+    # Hashes of the client code bundles the client has cached, set during
+    # negotiation.
+    code_hashes = ()
+    # Codecs the client supports, set during negotiation.
+    client_codecs = ()
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Codec used for job and result payloads, set during negotiation.
+        self.codec = LEGACY_CODEC
+        # Heartbeats are sent from their own thread, frames must not interleave.
+        self.send_lock = threading.Lock()
+        # Without the handshake round trip small frames would otherwise sit in
+        # Nagle's buffer waiting for a delayed ACK.
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
+
+    def send(self, msg_type, job_id, payload=b"", meta=None):
+        with self.send_lock:
+            send_frame(self.sock, msg_type, job_id, payload, meta)
+
+    def receive(self):
+        return receive_frame(self.sock)
+
+    # Breaks the connection from another thread, waking a blocked receive.
+    def abort(self):
+        abort_socket(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+class LegacyConnection:
+    protocol = "legacy"
+    heartbeat_interval = 0
+    parallelism = 1
+    prefetch = 0
+    combine = False
+    code_hashes = ()
+    client_codecs = ()
+
+    # incoming_type is the message type reported for everything received,
+    # MSG_RESULT on the manager side and MSG_JOB on the client side.
+    def __init__(self, sock, min_message_size, incoming_type):
+        self.sock = sock
+        self.min_message_size = min_message_size
+        self.incoming_type = incoming_type
+        self.codec = LEGACY_CODEC
+        # The legacy protocol is stop-and-wait, so whatever arrives next
+        # belongs to the last job that was sent.
+        self.last_job_id = 0
+
+    # meta can't be carried by the legacy protocol and is dropped.
+    def send(self, msg_type, job_id, payload=b"", meta=None):
+        if msg_type == MSG_CLOSE:
+            self.sock.send(b"Close")
+            return
+        self.last_job_id = job_id
+        send_large_message(self.sock, payload, self.min_message_size)
+
+    def receive(self):
+        msg = receive_large_message(self.sock, self.min_message_size)
+        if msg == b"Close":
+            return MSG_CLOSE, 0, msg, None
+        return self.incoming_type, self.last_job_id, msg, None
+
+    def abort(self):
+        abort_socket(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+def abort_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+# Legacy Helper Functions #
+
+# Sends a message using the size + "CONFIRMED" handshake. The message can be
+# a string or any buffer such as a NumPy array, bytearray or memoryview,
+# which is sent from its own memory.
+def send_large_message(sock, msg, min_message_size):
+    if not isinstance(msg, bytes):
+        msg = byte_view(msg)
+    sock.send(str(len(msg)).zfill(min_message_size))
+    sock.recv(min_message_size)
+    send_buffers(sock, [msg])
+
+
+# Receives a message from a socket. First receiving the size of the message
+# to be received, then reading the whole message into a preallocated buffer.
+# If out is given (a contiguous NumPy array or writable buffer of exactly the
+# advertised size) the message is received directly into it.
+
+def receive_large_message(sock, min_message_size, out=None):
+    # get size of message to be received
+    val = sock.recv(min_message_size)
+    if val == b"Close":
+        return val
+    incoming_size = int(val)
+    if out is not None and len(byte_view(out)) != incoming_size:
+        raise ValueError("Expected {} bytes but {} are incoming".format(len(byte_view(out)), incoming_size))
+    sock.send(b"CONFIRMED")
+    # receive message
+    if out is not None:
+        receive_into(sock, byte_view(out))
+        return out
+    responses = bytes(receive_exactly(sock, incoming_size))
+    if responses == b'':
+        raise Exception
+    return responses
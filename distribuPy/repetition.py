@@ -0,0 +1,23 @@
+import time
+
+
+# A repetition that is running while others are in flight. Each one has its
+# own task generator and its own buffer of tasks dropped by clients.
+class Repetition:
+    def __init__(self, index, task_gen):
+        self.index = index
+        self.task_gen = task_gen
+        self.drop_buffer = []
+        self.started_at = time.time()
+
+    # Returns up to count tasks, requeued ones first.
+    def take(self, count):
+        tasks = []
+        while len(tasks) < count and self.drop_buffer:
+            tasks.append(self.drop_buffer.pop())
+        while len(tasks) < count:
+            task = next(self.task_gen, None)
+            if task is None:
+                break
+            tasks.append(task)
+        return tasks
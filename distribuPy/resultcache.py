@@ -0,0 +1,95 @@
+import collections
+import hashlib
+import sqlite3
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Result Cache #
+
+# Remembers the response to every task so that a task that has been answered
+# before, under the same client code, is recorded without being sent to a
+# client again. Recent responses are kept in memory, and with a path every
+# response is also stored in an sqlite database that outlives the manager.
+
+# Pickle protocol used for keys, fixed so keys stay the same between runs.
+KEY_PROTOCOL = 2
+
+
+def as_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf-8")
+
+
+class ResultCache:
+    # max_entries bounds the in-memory tier. Responses are committed to the
+    # database every commit_interval stores and when the cache is closed.
+    def __init__(self, max_entries=10000, path=None, commit_interval=100):
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, response BLOB)")
+            self.db.commit()
+
+    # Returns the key of a task payload sent along with the client code
+    # bundle identified by code_hash.
+    def key(self, code_hash, payload):
+        return hashlib.sha1(as_bytes(code_hash) + pickle.dumps(payload, KEY_PROTOCOL)).hexdigest()
+
+    # Returns (True, response) for a known key, otherwise (False, None).
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                response = self.entries.pop(key)
+                self.entries[key] = response
+                self.hits += 1
+                return True, response
+            row = None
+            if self.db is not None:
+                row = self.db.execute("SELECT response FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            response = pickle.loads(bytes(row[0]))
+            self.remember(key, response)
+            self.hits += 1
+            return True, response
+
+    def put(self, key, response):
+        with self.lock:
+            self.remember(key, response)
+            if self.db is None:
+                return
+            data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", (key, sqlite3.Binary(data)))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.db.commit()
+                self.uncommitted = 0
+
+    # Adds a response to the in-memory tier, evicting the least recently
+    # used ones beyond max_entries. Must be called with the lock held.
+    def remember(self, key, response):
+        self.entries.pop(key, None)
+        self.entries[key] = response
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
@@ -0,0 +1,210 @@
+import array
+import struct
+import sys
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Payload Codecs #
+
+# A codec turns the list of task payloads in a job (or the list of responses
+# coming back) into bytes and back again. The codec used on a connection is
+# negotiated when the client is set up.
+
+# Protocol 5 where the interpreter has it, otherwise the best available.
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+# Payloads that the wire protocol can send straight from their own memory.
+BUFFER_TYPES = (bytearray, memoryview)
+if np is not None:
+    BUFFER_TYPES += (np.ndarray,)
+
+
+# The original format. Payloads are sent as str() joined by underscores and
+# the client task receives and returns the raw string. A job made of a single
+# buffer (such as a NumPy array) is sent as that buffer instead.
+class LegacyCodec:
+    name = "legacy"
+    # Structured codecs hand the client task a list and expect a list back.
+    structured = False
+    # Codecs that send several parts can only be used over framed connections.
+    requires_framing = False
+
+    def encode(self, items):
+        if len(items) == 1 and isinstance(items[0], BUFFER_TYPES):
+            return items[0]
+        return "_".join(str(item) for item in items)
+
+    def decode(self, data):
+        if not isinstance(data, bytes):
+            return [data]
+        return data.split("_")
+
+
+class PickleCodec:
+    name = "pickle"
+    structured = True
+    requires_framing = False
+
+    def encode(self, items):
+        return pickle.dumps(items, PICKLE_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+# Sends lists of floats as packed doubles and pickles everything else,
+# including tuples and lists holding anything but floats, so every item
+# decodes to what was encoded.
+class ArrayCodec:
+    name = "array"
+    structured = True
+    requires_framing = False
+
+    # Item count and whether the doubles are little endian.
+    HEADER = struct.Struct("!IB")
+    # Item kind and its size in bytes.
+    ITEM = struct.Struct("!BQ")
+    PICKLED = 0
+    DOUBLES = 1
+
+    def encode(self, items):
+        parts = [self.HEADER.pack(len(items), sys.byteorder == "little")]
+        for item in items:
+            if type(item) is list and len(item) != 0 and all(type(value) is float for value in item):
+                kind, data = self.DOUBLES, array_to_bytes(array.array("d", item))
+            else:
+                kind, data = self.PICKLED, pickle.dumps(item, PICKLE_PROTOCOL)
+            parts.append(self.ITEM.pack(kind, len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    def decode(self, data):
+        count, little_endian = self.HEADER.unpack_from(data)
+        swap = bool(little_endian) != (sys.byteorder == "little")
+        offset = self.HEADER.size
+        items = []
+        for i in range(count):
+            kind, size = self.ITEM.unpack_from(data, offset)
+            offset += self.ITEM.size
+            chunk = data[offset:offset + size]
+            offset += size
+            if kind == self.DOUBLES:
+                values = array.array("d")
+                array_from_bytes(values, chunk)
+                if swap:
+                    values.byteswap()
+                items.append(values.tolist())
+            else:
+                items.append(pickle.loads(chunk))
+        return items
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    structured = True
+    requires_framing = False
+
+    def encode(self, items):
+        return msgpack.packb(items, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Stands in for an array that travels as its own part of the payload.
+class ArrayRef:
+    def __init__(self, index, dtype, shape):
+        self.index = index
+        self.dtype = dtype
+        self.shape = shape
+
+
+# Pickles the structure of the payload but sends every NumPy array inside
+# lists, tuples and dicts as a separate part straight from its memory. The
+# receiver gets arrays that view the receive buffer, so neither side copies.
+class NdarrayCodec:
+    name = "ndarray"
+    structured = True
+    requires_framing = True
+
+    def encode(self, items):
+        arrays = []
+        skeleton = self.extract(items, arrays)
+        return [pickle.dumps(skeleton, PICKLE_PROTOCOL)] + arrays
+
+    def decode(self, parts):
+        return self.restore(pickle.loads(parts[0].tobytes()), parts)
+
+    def extract(self, obj, arrays):
+        if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+            arrays.append(np.ascontiguousarray(obj))
+            return ArrayRef(len(arrays) - 1, obj.dtype.str, obj.shape)
+        if type(obj) in (list, tuple):
+            return type(obj)(self.extract(item, arrays) for item in obj)
+        if type(obj) is dict:
+            return dict((key, self.extract(value, arrays)) for key, value in obj.items())
+        return obj
+
+    def restore(self, obj, parts):
+        if isinstance(obj, ArrayRef):
+            return parts[obj.index + 1].array(obj.dtype, obj.shape)
+        if type(obj) in (list, tuple):
+            return type(obj)(self.restore(item, parts) for item in obj)
+        if type(obj) is dict:
+            return dict((key, self.restore(value, parts)) for key, value in obj.items())
+        return obj
+
+
+def array_to_bytes(values):
+    if hasattr(values, "tobytes"):
+        return values.tobytes()
+    return values.tostring()
+
+
+def array_from_bytes(values, data):
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+
+
+LEGACY_CODEC = LegacyCodec()
+
+CODECS = {}
+
+
+# Makes a codec available for negotiation under its name.
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+# Names of the codecs this process can use.
+def available_codecs():
+    return sorted(CODECS.keys())
+
+
+register_codec(LEGACY_CODEC)
+register_codec(PickleCodec())
+register_codec(ArrayCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+if np is not None:
+    register_codec(NdarrayCodec())
@@ -0,0 +1,181 @@
+import math
+import time
+
+
+# Weight given to the newest measurement when smoothing timings.
+SMOOTHING = 0.3
+
+
+def smooth(previous, value):
+    if previous is None:
+        return value
+    return previous + SMOOTHING * (value - previous)
+
+
+# A job that has been dispatched and not yet answered. With speculative
+# execution it may be running on more than one session at once.
+class Job:
+    def __init__(self, job_id, tasks, repetition=None):
+        self.job_id = job_id
+        self.tasks = tasks
+        # Index of the repetition the tasks belong to when repetitions
+        # overlap, otherwise None.
+        self.repetition = repetition
+        # For a reduce job, the (tasks, response) pairs being combined.
+        self.partials = None
+        self.dispatched_at = time.time()
+        # Time by which the job must be answered, None if it can't be
+        # estimated yet.
+        self.deadline = None
+        self.sessions = set()
+
+
+# Scheduling state of one client connection, shared by both engines.
+class ClientSession:
+    def __init__(self, manager, connection, peer_name):
+        self.manager = manager
+        self.connection = connection
+        self.codec = connection.codec
+        self.peer_name = peer_name
+        # Time of the last message to or from the client.
+        self.last_contact = time.time()
+        # An unhealthy client missed a job deadline and gets no new jobs until
+        # it answers again.
+        self.healthy = True
+
+        # Jobs that have been sent but not answered, keyed by job id.
+        self.outstanding = {}
+        self.sent_at = {}
+        # Jobs this client is still running although another client already
+        # answered them. Their results are discarded.
+        self.cancelled = set()
+        # Legacy connections are stop-and-wait.
+        if connection.protocol == "framed":
+            # Prefetching clients hold extra jobs ready to compute.
+            self.window = manager.jobs_in_flight + connection.prefetch
+        else:
+            self.window = 1
+
+        # Clients running several tasks at once get proportionally larger
+        # jobs so every worker process has something to do.
+        self.parallelism = connection.parallelism
+        # Whether the client combines the responses to each job into one.
+        self.combining = connection.combine
+        # Handles of the shared objects the client has been sent, and the
+        # objects to send or release before the next job.
+        self.objects_sent = set()
+        self.object_queue = []
+        # Affinity keys of the tasks the client has been given.
+        self.affinity_keys = set()
+        # Names of the workloads whose client code the client has been
+        # sent, and the code frames to send before the next job.
+        self.code_sent = set()
+        self.code_queue = []
+        # Codec and whether the client combines, for the jobs of each
+        # workload's manager, see DistributedTaskManager.job_codec.
+        self.workload_codecs = {}
+        self.workload_combining = {}
+        self.tasks_per_job = manager.tasks_per_job * self.parallelism
+        # Smoothed compute seconds per task and non-compute seconds per job.
+        self.task_time = None
+        self.overhead = None
+        self.last_result_at = None
+
+    def has_room(self):
+        return self.healthy and len(self.outstanding) < self.window
+
+    def job_sent(self, job_id, tasks):
+        self.outstanding[job_id] = tasks
+        self.sent_at[job_id] = time.time()
+        self.last_contact = self.sent_at[job_id]
+
+    def heard_from(self):
+        self.last_contact = time.time()
+
+    # True if the client sends heartbeats and has been silent for longer than
+    # timeout seconds while it had work, counting jobs it is still running
+    # after they were cancelled. Idle clients aren't listened to, so they
+    # aren't expected to talk.
+    def is_silent(self, timeout, now):
+        return (self.connection.heartbeat_interval > 0 and bool(self.outstanding or self.cancelled)
+                and now - self.last_contact > timeout)
+
+    # Seconds the client should need for a job of task_count tasks sent now,
+    # including the jobs queued ahead of it, or None before it has been timed.
+    def expected_duration(self, task_count, task_time=None):
+        if self.task_time is not None:
+            task_time = self.task_time
+        if task_time is None:
+            return None
+        queued = sum(len(tasks) for tasks in self.outstanding.values())
+        return task_time * (task_count + queued)
+
+    # Forgets a job another client has answered, freeing its window slot.
+    def cancel(self, job_id):
+        if self.outstanding.pop(job_id, None) is not None:
+            self.sent_at.pop(job_id, None)
+            self.cancelled.add(job_id)
+
+    # Removes a finished job, updating the timings from it unless timed is
+    # False, and returns its tasks. meta is the metadata the client sent with
+    # the result. The job is only removed once the timings are updated, so it
+    # is still released with the session if they fail.
+    def job_finished(self, job_id, meta, timed=True):
+        tasks = self.outstanding[job_id]
+        now = time.time()
+        if timed:
+            self.time_job(tasks, self.sent_at[job_id], meta, now)
+        self.last_result_at = now
+        del self.outstanding[job_id]
+        del self.sent_at[job_id]
+        return tasks
+
+    # Updates the timings from a job of tasks sent at sent_at and answered at
+    # now.
+    def time_job(self, tasks, sent_at, meta, now):
+        # With several jobs in flight a job can only start once the one ahead
+        # of it is done, so time it from whichever happened last.
+        started = sent_at
+        if self.last_result_at is not None:
+            started = max(sent_at, self.last_result_at)
+
+        elapsed = now - started
+        compute = elapsed
+        if meta and "compute" in meta:
+            compute = min(meta["compute"], elapsed)
+        self.task_time = smooth(self.task_time, compute / len(tasks))
+        self.overhead = smooth(self.overhead, elapsed - compute)
+        if self.manager.adaptive_batching:
+            self.adapt_job_size()
+
+    # Moves tasks_per_job toward the size that makes a job take
+    # target_job_duration seconds, or a few round trips if that is longer.
+    def adapt_job_size(self):
+        manager = self.manager
+        duration = max(manager.target_job_duration, 2 * self.overhead)
+        if self.task_time > 0:
+            target = duration / self.task_time
+        else:
+            target = manager.max_tasks_per_job
+        # Change by at most a factor of two per job so one noisy measurement
+        # can't swing the size.
+        target = min(max(target, self.tasks_per_job / 2.0), self.tasks_per_job * 2.0)
+        target = min(max(target, manager.min_tasks_per_job * self.parallelism),
+                     manager.max_tasks_per_job * self.parallelism)
+        self.tasks_per_job = int(round(target))
+
+    # Number of tasks to put in the next job for this client.
+    def job_size(self):
+        manager = self.manager
+        size = self.tasks_per_job
+        if manager.adaptive_batching:
+            # Tasks are read ahead far enough to see the end coming before
+            # every client holds a job of this size.
+            manager.read_ahead_size = 2 * max(1, manager.connected) * size
+            remaining = manager.estimate_remaining_tasks()
+            if remaining is not None:
+                # Near the end of a repetition split what is left between the
+                # clients so no one holds a large batch at the tail.
+                share = int(math.ceil(remaining / (2.0 * max(1, manager.connected))))
+                size = max(manager.min_tasks_per_job, min(size, share))
+        return size
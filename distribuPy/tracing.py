@@ -0,0 +1,130 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+
+# Tracing #
+
+# With a Tracer the coordinator records a span for every step a task goes
+# through: taking it from the task generator, packaging and sending its job,
+# receiving the result, record_response, waiting in the jobBuffer and
+# record_job. Clients time decoding, computing and encoding every job and
+# send those spans back along with the result. write saves everything in
+# the Chrome trace event format, which chrome://tracing and Perfetto open.
+#
+# Client clocks needn't agree with the coordinator's. Every result also
+# carries the times the client received the job and sent the result, which
+# together with the times the coordinator sent the job and received the
+# result give the offset of the client's clock the way NTP does. The offset
+# measured over the job with the least network delay is used for every span
+# of that client.
+
+# Estimates how far a client's clock is ahead of the coordinator's.
+class ClockOffset:
+    def __init__(self):
+        self.offset = 0.0
+        self.delay = None
+
+    # sent and answered are coordinator times, received and replied are
+    # client times.
+    def sample(self, sent, received, replied, answered):
+        delay = (answered - sent) - (replied - received)
+        if self.delay is None or delay < self.delay:
+            self.delay = delay
+            self.offset = ((received - sent) + (replied - answered)) / 2.0
+
+
+class Tracer:
+    # The trace is written to path when the manager finishes, if it is given.
+    def __init__(self, path=None):
+        self.path = path
+        self.started = time.time()
+        # (worker, thread, name, category, start, end, args) entries. worker
+        # is None for the coordinator, thread is a thread name.
+        self.spans = []
+        # (name, category, start, end, args) entries for waits that overlap
+        # each other, such as jobs waiting in the jobBuffer.
+        self.waits = []
+        self.offsets = {}
+        self.lock = threading.Lock()
+
+    # Records a span of the calling coordinator thread, ending now unless
+    # end is given.
+    def span(self, name, category, start, end=None, args=None):
+        if end is None:
+            end = time.time()
+        entry = (None, threading.current_thread().name, name, category, start, end, args)
+        with self.lock:
+            self.spans.append(entry)
+
+    def wait(self, name, category, start, end=None, args=None):
+        if end is None:
+            end = time.time()
+        with self.lock:
+            self.waits.append((name, category, start, end, args))
+
+    # Records the spans a client sent back with the result to a job that
+    # the coordinator sent at sent and got the answer to at answered. trace
+    # is the "trace" entry of the result's metadata.
+    def client_spans(self, worker, job_id, sent, answered, trace):
+        with self.lock:
+            if worker not in self.offsets:
+                self.offsets[worker] = ClockOffset()
+            self.offsets[worker].sample(sent, trace["received"], trace["replied"], answered)
+            for name, thread, start, end in trace["spans"]:
+                self.spans.append((worker, thread, name, "client", start, end, {"job": job_id}))
+
+    # Returns the trace as a dict in the Chrome trace event format, with
+    # times in microseconds since the tracer was made.
+    def trace_events(self):
+        with self.lock:
+            spans = list(self.spans)
+            waits = list(self.waits)
+            offsets = dict((worker, clock.offset) for worker, clock in self.offsets.items())
+
+        pids = {None: 0}
+        tids = {}
+        events = [{"ph": "M", "name": "process_name", "pid": 0, "args": {"name": "coordinator"}}]
+
+        def timestamp(worker, when):
+            return (when - offsets.get(worker, 0.0) - self.started) * 1e6
+
+        for worker, thread, name, category, start, end, args in spans:
+            if worker not in pids:
+                pids[worker] = len(pids)
+                events.append({"ph": "M", "name": "process_name", "pid": pids[worker],
+                               "args": {"name": "worker {}".format(worker)}})
+            if (worker, thread) not in tids:
+                tids[(worker, thread)] = len(tids) + 1
+                events.append({"ph": "M", "name": "thread_name", "pid": pids[worker],
+                               "tid": tids[(worker, thread)], "args": {"name": thread}})
+            event = {"ph": "X", "name": name, "cat": category, "pid": pids[worker], "tid": tids[(worker, thread)],
+                     "ts": timestamp(worker, start), "dur": (end - start) * 1e6}
+            if args:
+                event["args"] = args
+            events.append(event)
+
+        ids = itertools.count(1)
+        for name, category, start, end, args in waits:
+            wait_id = next(ids)
+            begin = {"ph": "b", "name": name, "cat": category, "pid": 0, "id": wait_id, "ts": timestamp(None, start)}
+            if args:
+                begin["args"] = args
+            events.append(begin)
+            events.append({"ph": "e", "name": name, "cat": category, "pid": 0, "id": wait_id,
+                           "ts": timestamp(None, end)})
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"clock_offsets": dict((str(worker), offset) for worker, offset in offsets.items())}}
+
+    # Writes the trace to path, or to the path the tracer was made with.
+    def write(self, path=None):
+        path = path or self.path
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.trace_events(), f, default=repr)
+        os.rename(path + ".tmp", path)
+
+    def close(self):
+        if self.path is not None:
+            self.write()
@@ -0,0 +1,55 @@
+import multiprocessing
+
+
+# Worker Pool #
+
+# Runs the tasks of each job on a pool of local processes so that a single
+# client connection can use every core of its machine. The client code is
+# exec'd at runtime and can't be pickled, so the workers are forked after it
+# has been interpreted and inherit it through pool_task. Forking is only safe
+# while the client process has no other threads, so the pool is started from
+# setup before the client starts any threads of its own.
+
+# The ClientTask whose code the forked workers run.
+pool_task = None
+
+
+# Runs a chunk of tasks with the client code identified by code_hash, the
+# code the pool was started with if None.
+def run_chunk(chunk):
+    code_hash, tasks = chunk
+    client_task = pool_task.task_for(code_hash)
+    return client_task.task(client_task, tasks)
+
+
+def fork_context():
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing
+
+
+class WorkerPool:
+    # processes of None uses every core.
+    def __init__(self, client_task, processes=None):
+        global pool_task
+        self.processes = processes or multiprocessing.cpu_count()
+        pool_task = client_task
+        self.pool = fork_context().Pool(self.processes)
+
+    # Splits a job's list of tasks into one contiguous chunk per worker and
+    # returns the responses in task order. Client code other than the one the
+    # pool started with is loaded by the workers from the code cache.
+    def map(self, tasks, code_hash=None):
+        if len(tasks) < 2:
+            return run_chunk((code_hash, tasks))
+        count = min(self.processes, len(tasks))
+        bounds = [len(tasks) * i // count for i in range(count + 1)]
+        chunks = [(code_hash, tasks[bounds[i]:bounds[i + 1]]) for i in range(count)]
+        responses = []
+        for chunk_responses in self.pool.map(run_chunk, chunks):
+            responses.extend(chunk_responses)
+        return responses
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
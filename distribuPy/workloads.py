@@ -0,0 +1,233 @@
+import collections
+import socket
+import threading
+
+from .protocol import MSG_CODE, MSG_HEARTBEAT, encode_handshake
+from .distribuPy import DistributedTaskManager
+
+
+# Workloads #
+
+# Serves several workloads from one set of servers and clients. A workload
+# is an ordinary DistributedTaskManager with its own task generator, hooks
+# and client code that is added to a WorkloadManager instead of being set up
+# and started itself. Whenever a client has room for a job, the workloads
+# are asked for one in order of priority, and workloads of equal priority in
+# order of the compute time their jobs have used so far divided by their
+# weight, so each gets its weighted share of the clients. The client code
+# of a workload is sent to a client before its first job there, along with
+# the codec and whether to combine, which are negotiated for each workload
+# from its own codecs and client_combining. Serving several workloads needs
+# the framed protocol.
+
+# Attributes of the WorkloadManager that every workload shares, whenever
+# they are assigned.
+SHARED_ATTRIBUTES = ("object_store", "metrics", "tracer")
+
+class Workload:
+    def __init__(self, name, manager, weight, priority):
+        self.name = name
+        self.manager = manager
+        self.weight = weight
+        self.priority = priority
+        # Compute seconds used by the workload's jobs.
+        self.usage = 0.0
+        self.thread = None
+
+
+class WorkloadManager(DistributedTaskManager):
+    def __init__(self, tasks_per_job=20):
+        self.workloads = collections.OrderedDict()
+        self.workloads_lock = threading.Lock()
+        self.running = False
+        DistributedTaskManager.__init__(self, tasks_per_job)
+        # Codecs of the connections themselves. Clients only start worker
+        # processes over a structured codec.
+        self.codecs = ["pickle", "legacy"]
+
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        if name in SHARED_ATTRIBUTES:
+            for workload in list(self.__dict__.get("workloads", {}).values()):
+                setattr(workload.manager, name, value)
+
+    # Adds a workload under a unique name. Of the workloads with tasks to
+    # hand out, those with the highest priority are served first, and those
+    # of equal priority in proportion to their weights. Workloads that use
+    # the "processes" integration backend must be added before start_all.
+    def add_workload(self, name, manager, weight=1.0, priority=0):
+        manager.job_ids = self.job_ids
+        manager.jobs_lock = self.jobs_lock
+        manager.sessions = self.sessions
+        for attribute in SHARED_ATTRIBUTES:
+            setattr(manager, attribute, getattr(self, attribute))
+        manager.task_listeners.append(self.notify_tasks_available)
+        workload = Workload(name, manager, weight, priority)
+        with self.workloads_lock:
+            if name in self.workloads:
+                raise ValueError("There already is a workload named {}".format(name))
+            # A new workload starts level with the others instead of being
+            # owed everything they used before it arrived.
+            usages = [other.usage / other.weight for other in self.workloads.values() if not other.manager.stop]
+            workload.usage = min(usages) * weight if usages else 0.0
+            self.workloads[name] = workload
+            running = self.running
+        if running:
+            self.launch(workload)
+        self.notify_tasks_available()
+        return workload
+
+    # Runs every workload and stops once all of them have finished.
+    def simulation_management_thread(self):
+        with self.workloads_lock:
+            self.running = True
+            workloads = list(self.workloads.values())
+        for workload in workloads:
+            self.launch(workload)
+        with self.state_changed:
+            while not self.stop and not self.all_finished():
+                self.state_changed.wait()
+        for workload in list(self.workloads.values()):
+            workload.manager.request_stop()
+        self.request_stop()
+        # The workloads share the tracer, so it is only written once they
+        # are done with it.
+        for workload in list(self.workloads.values()):
+            if workload.thread is not None:
+                workload.thread.join()
+        self.wait_for_handlers()
+        if self.tracer is not None:
+            self.tracer.close()
+        self.close_servers()
+
+    def launch(self, workload):
+        workload.thread = threading.Thread(target=self.run_workload, args=(workload,))
+        workload.thread.start()
+
+    def run_workload(self, workload):
+        try:
+            workload.manager.simulation_management_thread()
+        finally:
+            self.notify_state_changed()
+            self.notify_tasks_available()
+
+    def all_finished(self):
+        with self.workloads_lock:
+            return bool(self.workloads) and all(workload.manager.stop for workload in self.workloads.values())
+
+    # Shard processes of every workload are forked before any threads run.
+    def start_integrator(self):
+        for workload in list(self.workloads.values()):
+            workload.manager.start_integrator()
+
+    # Workloads of higher priority first, then those furthest below their
+    # share.
+    def dispatch_order(self):
+        with self.workloads_lock:
+            workloads = [workload for workload in self.workloads.values() if not workload.manager.stop]
+        return sorted(workloads, key=lambda workload: (-workload.priority, workload.usage / workload.weight))
+
+    def choose_job(self, session):
+        if session.connection.protocol != "framed":
+            raise socket.error("Workloads can only be served over the framed protocol")
+        for workload in self.dispatch_order():
+            if not self.negotiate_workload(session, workload):
+                continue
+            job = workload.manager.choose_job(session)
+            if job is not None:
+                job_id, payload, meta = job
+                self.queue_code(session, workload)
+                meta = dict(meta or {})
+                meta["workload"] = workload.name
+                return job_id, payload, meta
+        return None
+
+    # Picks the codec of a workload's jobs for a session from the codecs of
+    # the workload and decides whether the client combines them. Returns
+    # False if the client supports none of the workload's codecs.
+    def negotiate_workload(self, session, workload):
+        manager = workload.manager
+        if manager in session.workload_codecs:
+            return session.workload_codecs[manager] is not None
+        try:
+            codec = manager.choose_codec(session.connection.client_codecs, "framed")
+        except socket.error as err:
+            self.log("{} can't run workload {}: {}".format(session.peer_name, workload.name, err))
+            codec = None
+        with self.jobs_lock:
+            session.workload_codecs[manager] = codec
+            session.workload_combining[manager] = codec is not None and manager.client_combines(codec, "framed")
+        return codec is not None
+
+    # Queues the client code of a workload for a client that doesn't have it.
+    def queue_code(self, session, workload):
+        if workload.name in session.code_sent:
+            return
+        manager = workload.manager
+        code = {"instructions": str([manager.client_labels, manager.client_code]), "modules": manager.client_modules}
+        if manager.code_hash() in session.connection.code_hashes:
+            code = {"instructions": None, "modules": []}
+        code["codec"] = manager.job_codec(session).name
+        code["combine"] = manager.combines(session)
+        meta = {"workload": workload.name, "code_hash": manager.code_hash()}
+        with self.jobs_lock:
+            session.code_sent.add(workload.name)
+            session.code_queue.append((MSG_CODE, 0, encode_handshake(code), meta))
+
+    # Client code goes out ahead of the shared objects its jobs refer to.
+    def pending_frames(self, session):
+        with self.jobs_lock:
+            frames, session.code_queue = session.code_queue, []
+        return frames + DistributedTaskManager.pending_frames(self, session)
+
+    # Every workload records into the metrics of the WorkloadManager, which
+    # reports the depths of their queues added up.
+    def metrics_gauges(self):
+        gauges = DistributedTaskManager.metrics_gauges(self)
+        for workload in list(self.workloads.values()):
+            for key, value in workload.manager.metrics_gauges().items():
+                if key != "connected_workers":
+                    gauges[key] += value
+        return gauges
+
+    # Hands results to the workload named in their metadata and charges it
+    # for the compute time.
+    def handle_message(self, session, msg_type, job_id, responses, meta):
+        if msg_type == MSG_HEARTBEAT:
+            session.heard_from()
+            return
+        with self.workloads_lock:
+            workload = self.workloads.get((meta or {}).get("workload"))
+            if workload is not None:
+                workload.usage += meta.get("compute", 0.0)
+        if workload is None:
+            raise socket.error("Result for job {} names no workload".format(job_id))
+        workload.manager.handle_message(session, msg_type, job_id, responses, meta)
+
+    def drop_session(self, session, err):
+        self.log(err)
+        self.log("{} has dropped!".format(session.peer_name))
+        with self.jobs_lock:
+            self.sessions.discard(session)
+            for workload in list(self.workloads.values()):
+                workload.manager.release_jobs(session)
+
+    def close_session(self, session):
+        with self.jobs_lock:
+            self.sessions.discard(session)
+        if session.affinity_keys:
+            for workload in list(self.workloads.values()):
+                workload.manager.affinity.forget(session)
+            session.affinity_keys = set()
+            self.notify_tasks_available()
+
+    # The WorkloadManager itself has no client code or tasks.
+    def read_in_client_code(self):
+        self.client_labels = "[]\n"
+        self.client_code = ""
+
+    def task_generator(self):
+        return iter(())
+
+    def reset_responses(self):
+        pass